@@ -0,0 +1,743 @@
+#--------------------------------#
+# Example usage:                 #
+# python chat_bench.py wakeup    #
+# python chat_bench.py batch     #
+# python chat_bench.py server    #
+# python chat_bench.py workers   #
+# python chat_bench.py codec     #
+# python chat_bench.py compress  #
+# python chat_bench.py log       #
+# python chat_bench.py tls       #
+# python chat_bench.py frames    #
+#--------------------------------#
+
+import os
+import sys
+import json
+import time
+import random
+import select
+import socket
+import ssl
+import resource
+import selectors
+import tempfile
+import subprocess
+
+import chat_server
+import chat_protocol
+import chat_log
+import chat_metrics
+
+
+# Connection counts to measure at
+CONNECTION_COUNTS = [16, 128, 512, 1000, 2000, 4000, 8000]
+# Wakeups to time at every connection count
+WAKEUPS = 2000
+# select() can not watch file descriptors past this
+FD_SETSIZE = 1024
+# Options every benchmark run of a server script gets. The benchmark
+# clients send far faster than people, so no rate limits.
+BENCH_SERVER_ARGS = {"chat_server.py": ["--rate-limit", "0", "--nick-rate-limit", "0"]}
+
+
+def raise_fd_limit():
+    """
+        Raise the open file limit as far as we are allowed to and return it.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or hard > soft:
+        newLimit = hard if hard != resource.RLIM_INFINITY else 65536
+        resource.setrlimit(resource.RLIMIT_NOFILE, (newLimit, hard))
+        soft = newLimit
+    return soft
+
+
+def make_idle_connections(count):
+    """
+        Return a list of connected socket pairs. Nothing is ever written to
+        them so they look like idle chat clients.
+    """
+    return [socket.socketpair() for _ in range(count)]
+
+
+def time_select_call(watched, activeReader, activeWriter):
+    """
+        Return the average seconds per wakeup of a select.select() call that
+        is rebuilt over every watched socket, like the old run_server loop.
+    """
+    start = time.perf_counter()
+    for _ in range(WAKEUPS):
+        activeWriter.send(b"x")
+        readyToRead, _, _ = select.select(watched, [], [])
+        activeReader.recv(1)
+    return (time.perf_counter() - start) / WAKEUPS
+
+
+def time_selector(backend, watched, activeReader, activeWriter):
+    """
+        Return the average seconds per wakeup of a selector that had every
+        watched socket registered once up front.
+    """
+    selector = chat_server.make_selector(backend)
+    for s in watched:
+        selector.register(s, chat_server.selectors.EVENT_READ)
+
+    start = time.perf_counter()
+    for _ in range(WAKEUPS):
+        activeWriter.send(b"x")
+        selector.select()
+        activeReader.recv(1)
+    elapsed = time.perf_counter() - start
+
+    selector.close()
+    return elapsed / WAKEUPS
+
+
+def bench_wakeup(argv):
+    """
+        Print the cost of one event loop wakeup as the number of connected,
+        idle clients grows. One client is active on every wakeup.
+    """
+    fdLimit = raise_fd_limit()
+    backends = [name for name, cls in chat_server.SELECTOR_BACKENDS.items()
+                if cls and name != "default"]
+
+    print(f"{'conns':>6}  {'select.select':>14}  " +
+          "  ".join(f"{name:>10}" for name in backends) + "   (usec/wakeup)")
+
+    for count in CONNECTION_COUNTS:
+        # Two fds per pair, plus some headroom for the selectors themselves
+        if count * 2 + 64 > fdLimit:
+            print(f"{count:>6}  skipped, open file limit is {fdLimit}")
+            continue
+
+        pairs = make_idle_connections(count)
+        activeReader, activeWriter = pairs[-1]
+        watched = [pair[0] for pair in pairs]
+
+        # select() fails outright once an fd is past FD_SETSIZE
+        if max(s.fileno() for s in watched) < FD_SETSIZE:
+            selectCost = f"{time_select_call(watched, activeReader, activeWriter) * 1e6:14.2f}"
+        else:
+            selectCost = f"{'n/a':>14}"
+
+        costs = []
+        for backend in backends:
+            if backend == "select" and max(s.fileno() for s in watched) >= FD_SETSIZE:
+                costs.append(f"{'n/a':>10}")
+                continue
+            cost = time_selector(backend, watched, activeReader, activeWriter)
+            costs.append(f"{cost * 1e6:10.2f}")
+
+        print(f"{count:>6}  {selectCost}  " + "  ".join(costs))
+
+        for a, b in pairs:
+            a.close()
+            b.close()
+
+
+def drain(sockets):
+    """
+        Read and throw away everything waiting on the given sockets.
+    """
+    for s in sockets:
+        try:
+            while s.recv(1 << 20):
+                pass
+        except BlockingIOError:
+            pass
+
+
+def run_broadcast_rounds(clientCount, messagesPerRound, rounds, batched):
+    """
+        Broadcast chat messages to clientCount in-process clients and return
+        the seconds spent in the server and its send counters. Unbatched
+        sends right after every broadcast, like before the per-round batcher.
+    """
+    chat_server.set_selector()
+    chat_metrics.reset()
+
+    pairs = make_idle_connections(clientCount)
+    serverConnections = []
+    for serverSide, clientSide in pairs:
+        serverSide.setblocking(False)
+        clientSide.setblocking(False)
+        serverConnections.append(chat_server.add_connection(serverSide))
+    clientSides = [pair[1] for pair in pairs]
+
+    message = {"type": "chat", "nick": "bench", "message": "x" * 80}
+    elapsed = 0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(messagesPerRound):
+            chat_server.transmit_to_clients(None, message)
+            if not batched:
+                chat_server.flush_round(None)
+        chat_server.flush_round(None)
+        elapsed += time.perf_counter() - start
+        drain(clientSides)
+
+    stats = chat_server.get_send_stats()
+    for connection in serverConnections:
+        chat_server.remove_connection(connection)
+    for serverSide, clientSide in pairs:
+        serverSide.close()
+        clientSide.close()
+    return elapsed, stats
+
+
+def bench_batch(argv):
+    """
+        Compare sending every broadcast right away with sending everything
+        broadcast in one event loop round together.
+    """
+    clientCount = int(argv[0]) if argv else 200
+    rounds = 50
+
+    print(f"{clientCount} clients, {rounds} rounds")
+    print(f"{'msgs/round':>10}  {'mode':>9}  {'usec/msg':>9}  {'frames/syscall':>14}  {'syscalls':>9}")
+    for messagesPerRound in (1, 4, 16, 64):
+        for batched in (False, True):
+            elapsed, stats = run_broadcast_rounds(clientCount, messagesPerRound, rounds, batched)
+            perMessage = elapsed / (messagesPerRound * rounds) * 1e6
+            mode = "batched" if batched else "unbatched"
+            print(f"{messagesPerRound:>10}  {mode:>9}  {perMessage:9.1f}  "
+                  f"{stats['frames_per_syscall']:14.2f}  {stats['syscalls']:>9}")
+
+
+def free_port():
+    """
+        Return a TCP port nothing is listening on right now.
+    """
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def start_server(script, port, extraArgs=()):
+    """
+        Start a chat server script in a child process and wait until it
+        accepts connections.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    extraArgs = [*BENCH_SERVER_ARGS.get(script, ()), *extraArgs]
+    process = subprocess.Popen([sys.executable, os.path.join(here, script), str(port), *extraArgs])
+
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("localhost", port)).close()
+            return process
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+
+    process.kill()
+    raise RuntimeError(f"{script} did not start listening on port {port}")
+
+
+def connect_client(port, nick, tlsContext=None):
+    """
+        Connect to the chat server and say hello, with TLS if a client
+        SSLContext is given.
+    """
+    s = socket.create_connection(("localhost", port))
+    if tlsContext is not None:
+        s = tlsContext.wrap_socket(s, server_hostname="localhost")
+    s.sendall(chat_server.encode_packet({"type": "hello", "nick": nick}))
+    return s
+
+
+def count_packets(buffer, packetType):
+    """
+        Remove every complete packet from a bytearray and return how many
+        of them were of the given type.
+    """
+    count = 0
+    offset = 0
+    while len(buffer) - offset >= 2:
+        packetLength = int.from_bytes(buffer[offset:offset + 2], "big")
+        if len(buffer) - offset - 2 < packetLength:
+            break
+        payload = json.loads(buffer[offset + 2:offset + 2 + packetLength])
+        if payload.get("type") == packetType:
+            count += 1
+        offset += 2 + packetLength
+    del buffer[:offset]
+    return count
+
+
+def run_fan_out(port, clientCount, messageCount, messageSize=80, tlsContext=None):
+    """
+        Connect clientCount clients, have one of them send messageCount chat
+        messages, and return the seconds until every client received all of
+        them. The sender is written to from the same loop that reads, since
+        an SSL socket can't be used by two threads at once.
+    """
+    clients = [connect_client(port, f"bench{i}", tlsContext) for i in range(clientCount)]
+
+    selector = selectors.DefaultSelector()
+    buffers = {}
+    received = {}
+    for s in clients:
+        s.setblocking(False)
+        selector.register(s, selectors.EVENT_READ)
+        buffers[s] = bytearray()
+        received[s] = 0
+
+    # Let the join packets arrive before the clock starts
+    time.sleep(0.2)
+    for s in clients:
+        try:
+            while s.recv(1 << 20):
+                pass
+        except (BlockingIOError, ssl.SSLWantReadError):
+            pass
+
+    packet = chat_server.encode_packet({"type": "chat", "message": "x" * messageSize})
+    sender = clients[0]
+    # Everything the sender has left to send, sent whenever it can take more
+    unsent = memoryview(packet * messageCount)
+    selector.modify(sender, selectors.EVENT_READ | selectors.EVENT_WRITE)
+
+    start = time.perf_counter()
+    unfinished = len(clients)
+    while unfinished:
+        for key, mask in selector.select(timeout=10):
+            s = key.fileobj
+            if mask & selectors.EVENT_WRITE:
+                try:
+                    unsent = unsent[s.send(unsent):]
+                except (BlockingIOError, ssl.SSLWantWriteError):
+                    pass
+                if not unsent:
+                    selector.modify(s, selectors.EVENT_READ)
+            if not mask & selectors.EVENT_READ:
+                continue
+
+            try:
+                data = s.recv(1 << 20)
+                # A TLS socket can have more decrypted than one recv() takes
+                while isinstance(s, ssl.SSLSocket) and s.pending():
+                    data += s.recv(1 << 20)
+            except (BlockingIOError, ssl.SSLWantReadError):
+                continue
+            if not data:
+                raise RuntimeError("server hung up during the benchmark")
+            buffers[s] += data
+            before = received[s]
+            received[s] += count_packets(buffers[s], "chat")
+            if before < messageCount <= received[s]:
+                unfinished -= 1
+    elapsed = time.perf_counter() - start
+
+    selector.close()
+    for s in clients:
+        s.close()
+    return elapsed
+
+
+def bench_server(argv):
+    """
+        Run the same fan-out load against each chat server implementation
+        and print delivered messages per second.
+        usage: chat_bench.py server [clients] [messages] [server script...]
+    """
+    clientCount = int(argv[0]) if len(argv) > 0 else 100
+    messageCount = int(argv[1]) if len(argv) > 1 else 2000
+    scripts = argv[2:] or ["chat_server.py", "chat_server_async.py"]
+
+    print(f"{clientCount} clients, {messageCount} messages from one sender")
+    print(f"{'server':>24}  {'seconds':>8}  {'delivered/s':>12}")
+    for script in scripts:
+        port = free_port()
+        process = start_server(script, port)
+        try:
+            elapsed = run_fan_out(port, clientCount, messageCount)
+        finally:
+            process.terminate()
+            process.wait()
+        delivered = clientCount * messageCount / elapsed
+        print(f"{script:>24}  {elapsed:8.3f}  {delivered:12.0f}")
+
+
+def bench_workers(argv):
+    """
+        Run the same fan-out load against chat_server.py with more and more
+        worker processes and print delivered messages per second.
+        usage: chat_bench.py workers [clients] [messages] [worker counts...]
+    """
+    clientCount = int(argv[0]) if len(argv) > 0 else 400
+    messageCount = int(argv[1]) if len(argv) > 1 else 1000
+    workerCounts = [int(count) for count in argv[2:]] or [1, 2, 4, 8]
+
+    print(f"{clientCount} clients, {messageCount} messages from one sender, "
+          f"{os.cpu_count()} CPUs")
+    print(f"{'workers':>7}  {'seconds':>8}  {'delivered/s':>12}")
+    for workerCount in workerCounts:
+        port = free_port()
+        process = start_server("chat_server.py", port, ["--workers", str(workerCount)])
+        try:
+            elapsed = run_fan_out(port, clientCount, messageCount)
+        finally:
+            process.terminate()
+            process.wait()
+        delivered = clientCount * messageCount / elapsed
+        print(f"{workerCount:>7}  {elapsed:8.3f}  {delivered:12.0f}")
+
+
+def time_per_call(function, argument, count):
+    """
+        Return the average seconds one call of function(argument) takes.
+    """
+    start = time.perf_counter()
+    for _ in range(count):
+        function(argument)
+    return (time.perf_counter() - start) / count
+
+
+def bench_codec(argv):
+    """
+        Print the CPU time per message to encode and decode chat payloads in
+        each encoding, for what the client sends and what the server sends.
+    """
+    count = int(argv[0]) if argv else 100000
+    messages = {
+        "client chat": {"type": "chat", "message": "hello everyone, how is it going?"},
+        "server chat": {"type": "chat", "nick": "chris", "message": "hello everyone, how is it going?"},
+        "server join": {"type": "join", "nick": "chris", "channel": "#lobby"},
+    }
+
+    print(f"{'payload':>12}  {'encoding':>8}  {'bytes':>5}  {'encode usec':>11}  {'decode usec':>11}")
+    for name, message in messages.items():
+        for encoding in chat_protocol.ENCODINGS:
+            payload = chat_protocol.encode_payload(message, encoding)
+            assert chat_protocol.decode_payload(payload) == message
+            encodeCost = time_per_call(lambda m: chat_protocol.encode_payload(m, encoding), message, count)
+            decodeCost = time_per_call(chat_protocol.decode_payload, payload, count)
+            print(f"{name:>12}  {encoding:>8}  {len(payload):>5}  "
+                  f"{encodeCost * 1e6:11.3f}  {decodeCost * 1e6:11.3f}")
+
+
+def make_chat_traffic(count):
+    """
+        Return count chat broadcasts that look like a busy room: bots
+        posting log lines and people repeating each other.
+    """
+    lines = [
+        "INFO worker-{n} finished job {i} in {ms}ms, queue depth {d}",
+        "WARN worker-{n} retrying job {i} after timeout ({ms}ms)",
+        "deploy {i} to staging finished, {d} pods healthy",
+        "has anyone looked at the flaky test in worker-{n}?",
+        "+1, seeing the same thing on job {i}",
+    ]
+    nicks = ["logbot", "deploybot", "chris", "alice", "bob"]
+    messages = []
+    for i in range(count):
+        text = lines[i % len(lines)].format(n=i % 8, i=1000 + i, ms=10 + i % 90, d=i % 5)
+        messages.append({"type": "chat", "nick": nicks[i % len(nicks)], "message": text})
+    return messages
+
+
+def bench_compress(argv):
+    """
+        Broadcast repetitive chat traffic to in-process clients with each
+        compression setting and print the bytes on the wire and the server
+        CPU per broadcast.
+    """
+    clientCount = int(argv[0]) if len(argv) > 0 else 100
+    messageCount = int(argv[1]) if len(argv) > 1 else 2000
+    messages = make_chat_traffic(messageCount)
+
+    print(f"{clientCount} clients, {messageCount} broadcasts")
+    print(f"{'compress':>14}  {'bytes/packet':>12}  {'saved':>6}  {'usec/broadcast':>14}")
+    # The packets are only built, never sent, so every client can share
+    # one unconnected socket
+    placeholder = socket.socket()
+    for compression in (None, *chat_protocol.COMPRESSIONS):
+        clients = [chat_server.Connection(placeholder) for _ in range(clientCount)]
+        for client in clients:
+            chat_server.set_compression(client, compression)
+        chat_metrics.reset()
+
+        wireBytes = 0
+        start = time.perf_counter()
+        for message in messages:
+            packets = {}
+            for client in clients:
+                wireBytes += len(chat_server.packet_for_client(client, message, packets))
+        elapsed = time.perf_counter() - start
+
+        perPacket = wireBytes / (clientCount * messageCount)
+        saved = chat_server.get_compression_stats()["saved_ratio"] if compression else 0
+        print(f"{compression or 'none':>14}  {perPacket:12.1f}  {saved:6.1%}  "
+              f"{elapsed / messageCount * 1e6:14.1f}")
+    placeholder.close()
+
+
+def slice_frames(chunks, framing):
+    """
+        Split packets the way the client did before FrameDecoder: a bytes
+        buffer sliced after every packet. Returns the payloads.
+    """
+    payloads = []
+    buffer = b""
+    for chunk in chunks:
+        buffer += chunk
+        while True:
+            header = chat_protocol.decode_length(buffer, 0, framing)
+            if header is None or len(buffer) < header[1] + header[0]:
+                break
+            packetLength, payloadStart = header
+            payloads.append(buffer[payloadStart:payloadStart + packetLength])
+            buffer = buffer[payloadStart + packetLength:]
+    return payloads
+
+
+def split_randomly(stream, rng, largest):
+    """
+        Return stream cut into pieces of 1 to largest bytes.
+    """
+    chunks = []
+    offset = 0
+    while offset < len(stream):
+        size = rng.randint(1, largest)
+        chunks.append(stream[offset:offset + size])
+        offset += size
+    return chunks
+
+
+def bench_frames(argv):
+    """
+        Check that FrameDecoder gets every payload back however the stream
+        is cut up, for every framing, then print how fast it splits a
+        stream of chat packets compared to slicing a bytes buffer.
+    """
+    messageCount = int(argv[0]) if len(argv) > 0 else 20000
+    fuzzRounds = int(argv[1]) if len(argv) > 1 else 50
+    rng = random.Random(1)
+    payloads = [chat_protocol.encode_payload(m) for m in make_chat_traffic(messageCount)]
+    # Some big ones too, like pasted logs
+    for i in range(0, messageCount, 1000):
+        payloads[i] = b"x" * rng.randint(1000, 60000)
+
+    for framing in chat_protocol.FRAMINGS:
+        stream = b"".join(chat_protocol.encode_length(len(p), framing) + p for p in payloads)
+        sample = payloads[:300]
+        sampleStream = b"".join(chat_protocol.encode_length(len(p), framing) + p for p in sample)
+        for _ in range(fuzzRounds):
+            chunks = split_randomly(sampleStream, rng, rng.choice((1, 7, 300, 65536)))
+            decoder = chat_protocol.FrameDecoder(framing)
+            decoded = []
+            if rng.random() < 0.5:
+                for chunk in chunks:
+                    decoded += decoder.decode(chunk, bytes)
+            else:
+                for chunk in chunks:
+                    decoder.feed(chunk)
+                    decoded += decoder
+            assert decoded == sample and len(decoder) == 0, framing
+        print(f"{framing:>6}: {fuzzRounds} randomly cut streams decoded correctly")
+
+    # A packet over the limit is refused from its length prefix alone
+    decoder = chat_protocol.FrameDecoder("u32", maxFrame=1024)
+    try:
+        decoder.decode(chat_protocol.encode_length(4096, "u32"))
+        raise AssertionError("oversized packet was accepted")
+    except ValueError:
+        pass
+
+    stream = b"".join(chat_protocol.encode_length(len(p), "u16") + p for p in payloads)
+    print(f"\n{messageCount} packets, {len(stream) / 1e6:.1f} MB")
+    print(f"{'reads':>12}  {'splitter':>20}  {'MB/s':>8}  {'packets/s':>10}")
+    for readName, chunks in (("4 KiB", [stream[i:i + 4096] for i in range(0, len(stream), 4096)]),
+                             ("64 KiB", [stream[i:i + 65536] for i in range(0, len(stream), 65536)]),
+                             ("random", split_randomly(stream, rng, 8192))):
+        def sliced():
+            return slice_frames(chunks, "u16")
+
+        def next_frame():
+            decoder = chat_protocol.FrameDecoder("u16")
+            out = []
+            for chunk in chunks:
+                decoder.feed(chunk)
+                out += decoder
+            return out
+
+        def decode():
+            decoder = chat_protocol.FrameDecoder("u16")
+            out = []
+            for chunk in chunks:
+                out += decoder.decode(chunk, len)
+            return out
+
+        for name, splitter in (("bytes slicing", sliced), ("FrameDecoder.feed", next_frame),
+                               ("FrameDecoder.decode", decode)):
+            start = time.perf_counter()
+            count = len(splitter())
+            elapsed = time.perf_counter() - start
+            assert count == messageCount
+            print(f"{readName:>12}  {name:>20}  {len(stream) / elapsed / 1e6:8.1f}  "
+                  f"{count / elapsed:10.0f}")
+
+
+def bench_log(argv):
+    """
+        Print what logging chat messages costs the event loop when the
+        writes are committed once per round and when every message is
+        written and fsync()ed on its own, then how long replaying history
+        takes.
+    """
+    messageCount = int(argv[0]) if len(argv) > 0 else 20000
+    perRound = int(argv[1]) if len(argv) > 1 else 32
+    messages = make_chat_traffic(messageCount)
+
+    print(f"{messageCount} messages, {perRound} per round")
+    print(f"{'commit':>14}  {'usec/message':>12}")
+    for mode in ("per-round", "per-message"):
+        with tempfile.TemporaryDirectory() as directory:
+            chat_log.open_log(directory)
+            # The fsync-per-message case is slow, so time fewer of them
+            count = messageCount if mode == "per-round" else min(messageCount, 500)
+            start = time.perf_counter()
+            for i in range(count):
+                chat_log.log_message(messages[i], "#lobby")
+                if mode == "per-message":
+                    chat_log.commit_log(sync=True)
+                elif i % perRound == perRound - 1:
+                    chat_log.commit_log()
+            chat_log.commit_log(sync=True)
+            elapsed = time.perf_counter() - start
+            chat_log.close_log()
+        print(f"{mode:>14}  {elapsed / count * 1e6:12.1f}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        chat_log.open_log(directory)
+        for message in messages:
+            chat_log.log_message(message, "#lobby")
+        chat_log.close_log()
+
+        # Reopening rebuilds the index from the segments
+        start = time.perf_counter()
+        chat_log.open_log(directory)
+        reopen = time.perf_counter() - start
+        print(f"reopen with {messageCount} messages: {reopen * 1e3:.1f} ms")
+        for count in (20, 200, 1000):
+            cost = time_per_call(lambda c: chat_log.read_history("#lobby", c), count, 200)
+            print(f"replay last {count:>4}: {cost * 1e6:8.1f} usec")
+        chat_log.close_log()
+
+
+def make_self_signed_cert(directory):
+    """
+        Make a self-signed certificate for localhost with the openssl
+        command and return the paths of the certificate and key files.
+    """
+    certFile = os.path.join(directory, "cert.pem")
+    keyFile = os.path.join(directory, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "ec",
+                    "-pkeyopt", "ec_paramgen_curve:prime256v1", "-nodes",
+                    "-keyout", keyFile, "-out", certFile, "-days", "1",
+                    "-subj", "/CN=localhost", "-addext", "subjectAltName=DNS:localhost"],
+                   check=True, capture_output=True)
+    return certFile, keyFile
+
+
+def time_connects(port, count, tlsContext=None, resume=False):
+    """
+        Return the average seconds to connect to the server, TLS handshake
+        included, and how many of the TLS sessions were resumed. Every
+        connection says hello and waits for its welcome, so the session
+        ticket has arrived before the next one connects.
+    """
+    session = None
+    elapsed = 0
+    resumed = 0
+    for i in range(count):
+        start = time.perf_counter()
+        s = socket.create_connection(("localhost", port))
+        if tlsContext is not None:
+            s = tlsContext.wrap_socket(s, server_hostname="localhost",
+                                       session=session if resume else None)
+        elapsed += time.perf_counter() - start
+
+        s.sendall(chat_server.encode_packet({"type": "hello", "nick": f"connect{i}"}))
+        s.recv(1 << 16)
+        if tlsContext is not None:
+            resumed += s.session_reused
+            session = s.session
+        s.close()
+    return elapsed / count, resumed
+
+
+def bench_tls(argv):
+    """
+        Compare plaintext and TLS with a self-signed certificate: the time
+        to connect with a full and a resumed handshake, then fan-out
+        throughput once everyone is connected.
+        usage: chat_bench.py tls [clients] [messages] [connects]
+    """
+    clientCount = int(argv[0]) if len(argv) > 0 else 100
+    messageCount = int(argv[1]) if len(argv) > 1 else 2000
+    connectCount = int(argv[2]) if len(argv) > 2 else 200
+
+    with tempfile.TemporaryDirectory() as directory:
+        certFile, keyFile = make_self_signed_cert(directory)
+        clientContext = ssl.create_default_context(cafile=certFile)
+        servers = {}
+        for mode in ("plain", "tls"):
+            port = free_port()
+            args = ["--tls-cert", certFile, "--tls-key", keyFile] if mode == "tls" else []
+            servers[mode] = (port, start_server("chat_server.py", port, args))
+
+        try:
+            print(f"{connectCount} connections each")
+            print(f"{'handshake':>12}  {'usec/connect':>12}  {'resumed':>7}")
+            plainPort, tlsPort = servers["plain"][0], servers["tls"][0]
+            for name, port, context, resume in (("plain", plainPort, None, False),
+                                                ("tls full", tlsPort, clientContext, False),
+                                                ("tls resumed", tlsPort, clientContext, True)):
+                cost, resumed = time_connects(port, connectCount, context, resume)
+                print(f"{name:>12}  {cost * 1e6:12.1f}  {resumed:>7}")
+
+            print(f"\n{clientCount} clients, {messageCount} messages from one sender")
+            print(f"{'transport':>12}  {'seconds':>8}  {'delivered/s':>12}")
+            for name, port, context in (("plain", plainPort, None),
+                                        ("tls", tlsPort, clientContext)):
+                elapsed = run_fan_out(port, clientCount, messageCount, tlsContext=context)
+                delivered = clientCount * messageCount / elapsed
+                print(f"{name:>12}  {elapsed:8.3f}  {delivered:12.0f}")
+        finally:
+            for port, process in servers.values():
+                process.terminate()
+                process.wait()
+
+
+# Runs a benchmark
+
+BENCHMARKS = {
+    "wakeup": bench_wakeup,
+    "batch": bench_batch,
+    "server": bench_server,
+    "workers": bench_workers,
+    "codec": bench_codec,
+    "compress": bench_compress,
+    "log": bench_log,
+    "tls": bench_tls,
+    "frames": bench_frames,
+}
+
+def usage():
+    print(f"usage: chat_bench.py {'|'.join(BENCHMARKS)} [args]", file=sys.stderr)
+
+def main(argv):
+    try:
+        benchmark = BENCHMARKS[argv[1]]
+    except:
+        usage()
+        return 1
+
+    benchmark(argv[2:])
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,362 @@
+#-------------------------------------------------------#
+# Example usage:                                        #
+# python chat_bot.py echobot localhost 3490             #
+# python chat_bot.py echobot localhost 3490 --bots 500  #
+#-------------------------------------------------------#
+
+# Chat client library for bots, scripts and integration tests. A ChatClient
+# is one asyncio connection to a chat server with nothing tied to a
+# terminal, so one process can run thousands of them:
+#
+#   async with ChatClient("bot", "localhost", 3490) as client:
+#       client.on("privmsg", lambda message: print(message["message"]))
+#       client.chat("hello")
+#       async for message in client:
+#           if message["type"] == "chat":
+#               print(message["nick"], message["message"])
+#
+# Every payload the server sends is an event, a message dictionary like
+# the ones in README.md. Callbacks registered with on() run as soon as an
+# event arrives, iterating over the client returns the events in order and
+# ends once the server hangs up. Pings are answered without either seeing
+# them. A callback that raises doesn't end the connection, the exception
+# goes to the event loop's exception handler, which logs it by default and
+# can be replaced to make a test fail.
+#
+# Run as a script it starts echo bots that answer every chat message
+# starting with their nick.
+
+import sys
+import asyncio
+import inspect
+import argparse
+from collections import deque
+
+import chat_protocol
+
+
+# Events kept for iteration, the oldest are dropped past this so a client
+# only driven by callbacks doesn't grow
+EVENT_QUEUE_SIZE = 1000
+# Seconds connect() waits for the welcome
+CONNECT_TIMEOUT = 10.0
+# Most bytes read from the socket at once
+READ_SIZE = 65536
+
+
+class ChatClient:
+    """
+        One connection to a chat server. connect() says hello and returns
+        the welcome, send() and the helpers after it queue packets without
+        waiting, drain() waits for them to go out, close() hangs up.
+    """
+    __slots__ = ("nick", "host", "port", "encoding", "framing", "compress",
+                 "tls", "channels", "reader", "writer", "decoder",
+                 "decompressor", "callbacks", "callbackTasks", "events",
+                 "dropped", "eventReady", "closed", "readerTask", "welcome")
+
+    def __init__(self, nick, host="localhost", port=3490, encoding="json",
+                 framing="u16", compress=None, tls=None, channels=()):
+        """
+            encoding, framing and compress are asked for in the hello, as
+            with chat_client.py. tls is an SSLContext to connect with, and
+            channels are joined besides the default one.
+        """
+        self.nick = nick
+        self.host = host
+        self.port = port
+        self.encoding = encoding
+        self.framing = framing
+        self.compress = compress
+        self.tls = tls
+        self.channels = tuple(channels)
+        self.reader = None
+        self.writer = None
+        # The server's packets switch to our framing after the welcome
+        self.decoder = chat_protocol.FrameDecoder("u16")
+        self.decompressor = None
+        # Event type -> functions to call, "*" for every event
+        self.callbacks = {}
+        # Coroutine callbacks still running, kept so they aren't garbage
+        # collected before they finish
+        self.callbackTasks = set()
+        # Events not iterated over yet, and how many were dropped for it
+        self.events = deque(maxlen=EVENT_QUEUE_SIZE)
+        self.dropped = 0
+        # Set while events are waiting or the connection is closed
+        self.eventReady = asyncio.Event()
+        self.closed = False
+        self.readerTask = None
+        # The welcome, once the server sent it
+        self.welcome = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, excType, exc, traceback):
+        await self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """
+            Return the next event, waiting for it if need be. Stops once
+            the connection is closed and every event was returned.
+        """
+        while not self.events:
+            if self.closed:
+                raise StopAsyncIteration
+            self.eventReady.clear()
+            await self.eventReady.wait()
+        return self.events.popleft()
+
+    async def connect(self, timeout=CONNECT_TIMEOUT):
+        """
+            Connect, say hello and return the welcome. Raises
+            ConnectionError if the server turns the hello down, like for a
+            nick that is taken.
+        """
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host, self.port, ssl=self.tls,
+            server_hostname=self.host if self.tls is not None else None)
+        if self.compress == "deflate-stream":
+            self.decompressor = chat_protocol.make_decompressor()
+
+        # The hello itself is always JSON with a u16 length, the encoding
+        # and framing apply to everything after it
+        hello = {"type": "hello", "nick": self.nick}
+        if self.encoding != "json":
+            hello["encoding"] = self.encoding
+        if self.framing != "u16":
+            hello["version"] = 2
+            hello["framing"] = self.framing
+        if self.compress:
+            hello["compress"] = self.compress
+        if self.channels:
+            hello["channels"] = list(self.channels)
+        self.send(hello, "json", "u16")
+
+        welcomed = asyncio.get_running_loop().create_future()
+        self.readerTask = asyncio.create_task(self.read_events(welcomed))
+        try:
+            self.welcome = await asyncio.wait_for(welcomed, timeout)
+        except BaseException:
+            await self.close()
+            raise
+        return self.welcome
+
+    async def close(self):
+        """
+            Hang up and wait for the connection to close.
+        """
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        if self.readerTask is not None:
+            await asyncio.gather(self.readerTask, return_exceptions=True)
+        self.end_events()
+
+    def on(self, eventType, callback):
+        """
+            Call callback(message) for every event of eventType, or for
+            every event with "*". A coroutine function is run as a task.
+        """
+        self.callbacks.setdefault(eventType, []).append(callback)
+
+    def send(self, message, encoding=None, framing=None):
+        """
+            Queue a message dictionary to be sent. Raises ConnectionError
+            once the connection is closed.
+        """
+        if self.writer is None or self.writer.is_closing():
+            raise ConnectionError("not connected")
+        payload = chat_protocol.encode_payload(message, encoding or self.encoding)
+        self.writer.write(chat_protocol.encode_length(len(payload), framing or self.framing) + payload)
+
+    async def drain(self):
+        """
+            Wait until the queued packets are handed to the socket, for
+            senders that could outrun it.
+        """
+        await self.writer.drain()
+
+    def chat(self, text, channel=None):
+        message = {"type": "chat", "message": text}
+        if channel is not None:
+            message["channel"] = channel
+        self.send(message)
+
+    def join(self, channel):
+        self.send({"type": "join", "channel": channel})
+
+    def part(self, channel):
+        self.send({"type": "part", "channel": channel})
+
+    def privmsg(self, nick, text):
+        self.send({"type": "privmsg", "nick": nick, "message": text})
+
+    def history(self, channel, count):
+        self.send({"type": "history", "channel": channel, "count": count})
+
+    async def read_events(self, welcomed):
+        """
+            Read the server's packets until it hangs up, and hand each one
+            to the callbacks and the event queue.
+        """
+        try:
+            while True:
+                data = await self.reader.read(READ_SIZE)
+                if not data:
+                    break
+                messages = self.decoder.decode(data, self.decode_message, is_welcome)
+                while messages:
+                    for message in messages:
+                        self.handle_event(message, welcomed)
+                    # Decoding stopped at the welcome, the rest is in the
+                    # framing asked for
+                    if not is_welcome(messages[-1]):
+                        break
+                    self.decoder.framing = self.framing
+                    messages = self.decoder.decode(b"", self.decode_message)
+                if self.events:
+                    self.eventReady.set()
+        except (OSError, ValueError):
+            # Gone, or sent something that isn't the chat protocol
+            pass
+        finally:
+            if not welcomed.done():
+                welcomed.set_exception(ConnectionError("connection closed before the welcome"))
+            if self.writer is not None:
+                self.writer.close()
+            self.end_events()
+
+    def decode_message(self, payload):
+        """
+            Return the message in a payload from the server.
+        """
+        if self.compress:
+            payload = chat_protocol.decompress_payload(payload, self.decompressor)
+        return chat_protocol.decode_payload(payload)
+
+    def handle_event(self, message, welcomed):
+        """
+            Act on one message from the server.
+        """
+        messageType = message.get("type")
+        if messageType == "ping":
+            self.send({"type": "pong"})
+            return
+        if not welcomed.done():
+            if messageType == "welcome":
+                welcomed.set_result(message)
+            elif messageType == "error":
+                welcomed.set_exception(ConnectionError(message.get("message", "hello refused")))
+
+        if self.callbacks:
+            for callback in self.callbacks.get(messageType, []) + self.callbacks.get("*", []):
+                self.run_callback(callback, message)
+
+        if len(self.events) == EVENT_QUEUE_SIZE:
+            self.dropped += 1
+        self.events.append(message)
+
+    def run_callback(self, callback, message):
+        """
+            Call a callback for an event, and run what it returns as a task
+            if it is a coroutine. What either raises is reported.
+        """
+        try:
+            result = callback(message)
+        except Exception as e:
+            self.report_callback_error(callback, message, e)
+            return
+        if inspect.isawaitable(result):
+            task = asyncio.ensure_future(result)
+            self.callbackTasks.add(task)
+            task.add_done_callback(lambda task: self.callback_done(task, callback, message))
+
+    def callback_done(self, task, callback, message):
+        """
+            Forget a finished callback task, reporting what it raised.
+        """
+        self.callbackTasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.report_callback_error(callback, message, task.exception())
+
+    def report_callback_error(self, callback, message, exception):
+        """
+            Hand an exception from a callback to the event loop's exception
+            handler.
+        """
+        asyncio.get_running_loop().call_exception_handler({
+            "message": f"ChatClient {self.nick}: callback {callback!r} failed "
+                       f"on a {message.get('type')} event",
+            "exception": exception,
+        })
+
+    def end_events(self):
+        """
+            Let iteration end once the queued events are returned.
+        """
+        self.closed = True
+        self.eventReady.set()
+
+
+def is_welcome(message):
+    """
+        Return True for a welcome message.
+    """
+    return message.get("type") == "welcome"
+
+
+
+# ---- Functions for the echo bot -----
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="chat_bot.py")
+    parser.add_argument("nick")
+    parser.add_argument("host")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--bots", type=int, default=1,
+        help="echo bots to run, named nick0, nick1, ... when more than one")
+    return parser.parse_args(argv[1:])
+
+
+async def run_echo_bot(nick, host, port):
+    """
+        Answer every chat message that starts with "nick:" until the server
+        hangs up.
+    """
+    async with ChatClient(nick, host, port) as client:
+        prefix = f"{nick}:"
+        async for message in client:
+            text = message.get("message")
+            if message.get("type") == "chat" and isinstance(text, str) and text.startswith(prefix):
+                client.chat(f"{message.get('nick')}: {text[len(prefix):].strip()}",
+                            message.get("channel"))
+
+
+async def run_echo_bots(args):
+    nicks = [args.nick] if args.bots == 1 else [f"{args.nick}{i}" for i in range(args.bots)]
+    await asyncio.gather(*(run_echo_bot(nick, args.host, args.port) for nick in nicks))
+
+
+def main(argv):
+    args = parse_args(argv)
+    try:
+        asyncio.run(run_echo_bots(args))
+    except KeyboardInterrupt:
+        pass
+    except ConnectionError as e:
+        print(f"chat_bot.py: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+# ---- End of Functions for the echo bot -----
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
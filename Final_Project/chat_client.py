@@ -7,164 +7,702 @@
 # The first argument is a prefix that the server will print to make it
 # easier to tell the different clients apart. You can put anything
 # there.
+import os
 import sys
+import ssl
+import time
+import random
+import select
 import socket
-import json
+import argparse
+import selectors
 import threading
 from chatui import init_windows, read_command, print_message, end_windows
+from chatui import scroll_up, scroll_down, search_scrollback, show_prompt
 
+import chat_protocol
 
-def usage():
-    print("usage: select_client.py prefix host port", file=sys.stderr)
+# Channel the server puts everyone in, chat without a channel goes there
+DEFAULT_CHANNEL = "#lobby"
+# Channel the user is talking in
+currentChannel = DEFAULT_CHANNEL
+# Payload encoding used to talk to the server
+wireEncoding = "json"
+# Length prefix of what we send. It switches right after the hello, what
+# the server sends only after its welcome, see packetDecoder.
+wireFraming = "u16"
+# Decompression context for a deflate-stream connection
+wireDecompressor = None
+# Earlier messages to ask for when joining a channel
+historyCount = 0
+# Seconds to wait before the first reconnect attempt, doubled after every
+# failed one up to the most
+RECONNECT_DELAY = 0.5
+MAX_RECONNECT_DELAY = 30
+# Seconds a server that is going down asked us to wait before
+# reconnecting, used once instead of RECONNECT_DELAY
+retryAfter = None
+# Waits before the coming reconnect attempts, only started over once a
+# server welcomes us, so one that accepts and hangs up right away doesn't
+# reset them
+reconnectWaits = None
+# Set once the server refused our nick, reconnecting would only be
+# refused again
+nickTaken = False
+# The socket to the server, replaced when reconnecting
+serverSocket = None
+# Where the server is, and the hello to send it, without the resume fields
+serverAddress = None
+helloMessage = None
+# Framing and compression asked for in the hello
+requestedFraming = "u16"
+requestedCompression = None
+# Newest broadcast sequence number seen, and the server run it is from
+lastSeq = None
+serverEpoch = None
+# Token from the welcome that lets a reconnect take our nick back from a
+# connection the server hasn't noticed is gone
+resumeToken = None
+# Channels joined besides the default one, joined again on reconnect
+joinedChannels = set()
+# TLS context to wrap the connection in, None for plaintext, and the
+# session to resume when reconnecting
+tlsContext = None
+tlsSession = None
+# With --select the one loop that reads stdin and the server, and the
+# packets waiting for the server socket to take them
+clientSelector = None
+outgoing = bytearray()
+# Most bytes handed to an SSL socket at once, it has no partial sendall()
+TLS_SEND_SIZE = 16384
+# The input loop and the runner thread both send, one packet at a time.
+# A TLS connection is read under it too, an SSL socket can't be used by
+# two threads at once.
+sendLock = threading.Lock()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="chat_client.py")
+    parser.add_argument("nick")
+    parser.add_argument("host")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--encoding", default="json", choices=chat_protocol.ENCODINGS,
+        help="payload encoding to ask the server for")
+    parser.add_argument("--framing", default="u16", choices=list(chat_protocol.FRAMINGS),
+        help="length prefix to switch to after hello, anything but u16 "
+             "needs a version 2 server and allows messages over 64 KiB")
+    parser.add_argument("--compress", choices=chat_protocol.COMPRESSIONS,
+        help="ask the server to compress what it sends")
+    parser.add_argument("--history", type=int, default=20,
+        help="earlier messages to show when joining a channel, 0 for none")
+    parser.add_argument("--tls", action="store_true",
+        help="connect with TLS")
+    parser.add_argument("--tls-ca",
+        help="PEM certificate to trust for --tls, like a self-signed server's, "
+             "instead of the system's")
+    parser.add_argument("--select", action="store_true",
+        help="read the keyboard and the server in one selectors loop instead "
+             "of a reader thread")
+    parser.add_argument("--headless", action="store_true",
+        help="no chat window: send every line from stdin and print every "
+             "message to stdout, for bots and pipes, implies --select")
+    return parser.parse_args(argv[1:])
 
 def main(argv):
     """
         Create a chat UI that allows the user to chat with other users through
         a chat server. Is able to both send and receive messages at the same time.
     """
-    try:
-        nick = argv[1]
-        host = argv[2]
-        port = int(argv[3])
-    except:
-        usage()
-        return 1
-
-    # Make the client socket and connect
-    serverSocket = socket.socket()
-    serverSocket.connect((host, port))
-    
-    # Send connect message to server
+    global wireEncoding, historyCount, serverAddress, helloMessage
+    global requestedFraming, requestedCompression, tlsContext, print_message
+
+    args = parse_args(argv)
+    nick = args.nick
+
+    # The hello itself is always JSON with a u16 length, the encoding and
+    # framing apply to everything after it.
     joinMessage = {"type": "hello", "nick": nick}
-    send_message(serverSocket, joinMessage)
+    if args.encoding != "json":
+        joinMessage["encoding"] = args.encoding
+    if args.framing != "u16":
+        joinMessage["version"] = 2
+        joinMessage["framing"] = args.framing
+    if args.compress:
+        joinMessage["compress"] = args.compress
+    serverAddress = (args.host, args.port)
+    helloMessage = joinMessage
+    wireEncoding = args.encoding
+    requestedFraming = args.framing
+    requestedCompression = args.compress
+    historyCount = args.history
+    if args.tls:
+        tlsContext = ssl.create_default_context(cafile=args.tls_ca)
+    if args.headless:
+        # Plain lines in and out
+        print_message = print_line
+
+    # Make the client socket, connect and say hello
+    connect_to_server()
+    request_history(serverSocket, DEFAULT_CHANNEL, historyCount)
+
+    if args.select or args.headless:
+        run_select_loop(nick, args.headless)
+        return
 
     # Start Chat Windows    
     init_windows()
 
     # Create a thread that handles incomming messages from the server.
-    t1 = threading.Thread(target=runner, args=([serverSocket]), daemon=True)
+    t1 = threading.Thread(target=runner, daemon=True)
     t1.start()
 
     while True:
         try:
-            messageInput = read_command(nick + "> ")
+            messageInput = read_command(f"{nick} {currentChannel}> ")
         except:
             break
         
+        send_input(messageInput)
+
+    end_windows()
+
+def send_input(messageInput):
+    """
+        Send a line the user typed as a chat message, or carry out the
+        action it asks for.
+    """
+    try:
         # Special Character Used, Action Needed
-        if messageInput[:1] == "/":
-            parseAction(messageInput)
-        
+        if messageInput[:1] == "/" and parseAction(messageInput, serverSocket):
+            return
+
         # Prepare the message to send
         messageToSend = {"type": "chat", "message": messageInput}
-        
+        if currentChannel != DEFAULT_CHANNEL:
+            messageToSend["channel"] = currentChannel
+
         # Send message to server
         send_message(serverSocket, messageToSend)
+    except OSError:
+        # Lost the connection, it is being reconnected
+        print_message("*** not connected, message not sent")
 
-    end_windows()
+def run_select_loop(nick, headless):
+    """
+        Read the keyboard, or stdin when headless, and the server in one
+        selectors loop, so nothing needs a thread and only this loop writes
+        to the terminal. Packets to the server wait in outgoing until its
+        socket takes them, so a bot sending fast never stops reading.
+        Once stdin ends and everything typed has been sent the connection
+        is closed for writing, and this returns when the server hangs up.
+    """
+    global clientSelector
+
+    clientSelector = selectors.DefaultSelector()
+    stdinFd = sys.stdin.fileno()
+    clientSelector.register(stdinFd, selectors.EVENT_READ)
+    watch_server()
+    inputBuffer = bytearray()
+    inputOpen = True
+    # Shut down for writing after the last packet
+    closing = False
+    # When to try reconnecting next, while disconnected
+    reconnectAt = None
+
+    if not headless:
+        init_windows()
+        show_prompt(f"{nick} {currentChannel}> ")
+
+    try:
+        # Nothing left to send once disconnected with stdin at its end
+        while inputOpen or reconnectAt is None:
+            timeout = None
+            if reconnectAt is not None:
+                timeout = max(0.0, reconnectAt - time.monotonic())
+
+            for key, mask in clientSelector.select(timeout):
+                if key.fileobj == stdinFd:
+                    data = os.read(stdinFd, 65536)
+                    if not data:
+                        inputOpen = False
+                        clientSelector.unregister(stdinFd)
+                        continue
+                    inputBuffer += data
+                    lines = inputBuffer.split(b"\n")
+                    inputBuffer[:] = lines.pop()
+                    for line in lines:
+                        send_input(line.decode(errors="replace").strip())
+                    if not headless:
+                        show_prompt(f"{nick} {currentChannel}> ")
+                    continue
+
+                # The server, it might have gone away on an earlier event
+                if key.fileobj is not serverSocket:
+                    continue
+                connected = True
+                if mask & selectors.EVENT_WRITE:
+                    connected = flush_outgoing()
+                if connected and mask & selectors.EVENT_READ:
+                    connected = read_server()
+                if not connected:
+                    clientSelector.unregister(serverSocket)
+                    serverSocket.close()
+                    if closing:
+                        return
+                    if nickTaken:
+                        print_message("*** not reconnecting, try another nick")
+                        return
+                    print_message("*** connection lost, reconnecting")
+                    reconnectAt = time.monotonic() + next_reconnect_wait()
+
+            if reconnectAt is not None and time.monotonic() >= reconnectAt:
+                try:
+                    connect_to_server()
+                    watch_server()
+                    reconnectAt = None
+                except OSError:
+                    reconnectAt = time.monotonic() + next_reconnect_wait()
+
+            # Let the server read the last packets before hanging up, a
+            # close with its packets still unread would reset the connection
+            if not inputOpen and not outgoing and reconnectAt is None and not closing:
+                closing = True
+                try:
+                    serverSocket.shutdown(socket.SHUT_WR)
+                except OSError:
+                    return
+
+            if headless:
+                sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if headless:
+            sys.stdout.flush()
+        else:
+            end_windows()
+
+def watch_server():
+    """
+        Have the select loop read the server socket, and write to it while
+        packets are waiting.
+    """
+    serverSocket.setblocking(False)
+    events = selectors.EVENT_READ
+    if outgoing:
+        events |= selectors.EVENT_WRITE
+    try:
+        clientSelector.modify(serverSocket, events)
+    except KeyError:
+        clientSelector.register(serverSocket, events)
+
+def flush_outgoing():
+    """
+        Send as much of outgoing as the server socket takes. Returns False
+        if the connection is gone.
+    """
+    try:
+        while outgoing:
+            if isinstance(serverSocket, ssl.SSLSocket):
+                # A retried SSL write must start with the same bytes
+                sent = serverSocket.send(outgoing[:TLS_SEND_SIZE])
+            else:
+                sent = serverSocket.send(outgoing)
+            del outgoing[:sent]
+    except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+        pass
+    except OSError:
+        return False
+
+    watch_server()
+    return True
+
+def read_server():
+    """
+        Show everything the server has sent. Returns False once it has hung
+        up.
+    """
+    try:
+        while True:
+            newData = serverSocket.recv(65536)
+            if not newData:
+                return False
+            packetDecoder.feed(newData)
+            # An SSL socket can hold decrypted data select() doesn't see
+            if not isinstance(serverSocket, ssl.SSLSocket) or not serverSocket.pending():
+                break
+    except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+        pass
+    except OSError:
+        return False
+
+    try:
+        for payload in packetDecoder:
+            toChatWindow = handle_packet(payload)
+            if toChatWindow is not None:
+                print_message(toChatWindow)
+    except ValueError:
+        # Not the chat protocol, or a broken compression stream
+        return False
+    return True
+
+def print_line(s):
+    """
+        Show a message as a line on stdout, for --headless.
+    """
+    sys.stdout.write(s + "\n")
 
-def parseAction(input):
+def connect_to_server():
+    """
+        Connect to the server and say hello. After a reconnect the hello
+        carries the newest sequence number seen, so the server can replay
+        what was missed, and the channels to join again.
+    """
+    global serverSocket, wireFraming, wireDecompressor, packetDecoder
+
+    newSocket = socket.create_connection(serverAddress)
+    if tlsContext is not None:
+        # Resuming the last session skips most of the handshake
+        try:
+            newSocket = tlsContext.wrap_socket(newSocket, server_hostname=serverAddress[0],
+                                               session=tlsSession)
+        except OSError:
+            newSocket.close()
+            raise
+
+    hello = dict(helloMessage)
+    if lastSeq is not None:
+        hello["last_seq"] = lastSeq
+        hello["epoch"] = serverEpoch
+    if resumeToken is not None:
+        hello["token"] = resumeToken
+    if joinedChannels:
+        hello["channels"] = sorted(joinedChannels)
+    send_message(newSocket, hello, "json", "u16")
+
+    # A new connection starts from scratch on both ends
+    wireFraming = requestedFraming
+    wireDecompressor = None
+    if requestedCompression == "deflate-stream":
+        wireDecompressor = chat_protocol.make_decompressor()
+    packetDecoder = chat_protocol.FrameDecoder("u16")
+    del outgoing[:]
+    serverSocket = newSocket
+
+def reconnect():
+    """
+        Keep trying to connect to the server again, waiting twice as long
+        after every failed attempt, with some jitter so a restarted server
+        isn't hit by every client at once.
+    """
+    print_message("*** connection lost, reconnecting")
+    while True:
+        time.sleep(next_reconnect_wait())
+        try:
+            connect_to_server()
+            return
+        except OSError:
+            pass
+
+def next_reconnect_wait():
+    """
+        Return how long to wait before the next reconnect attempt, carrying
+        on from the last attempts until a welcome resets them.
+    """
+    global reconnectWaits
+
+    if reconnectWaits is None:
+        reconnectWaits = reconnect_waits()
+    return next(reconnectWaits)
+
+def reconnect_waits():
+    """
+        Yield how long to wait before every reconnect attempt.
+    """
+    global retryAfter
+
+    delay = RECONNECT_DELAY
+    # A server that went down already spread out its clients' reconnects
+    firstWait, retryAfter = retryAfter, None
+    if firstWait is None:
+        firstWait = delay * random.uniform(0.5, 1.0)
+    yield firstWait
+    while True:
+        delay = min(delay * 2, MAX_RECONNECT_DELAY)
+        yield delay * random.uniform(0.5, 1.0)
+
+def parseAction(input, serverSocket):
     """
         Check to see if the user is trying to preform a special action.
+        Returns True if the input was an action and should not be sent as
+        a chat message.
+
+        /join #channel   join a channel and talk in it
+        /part [#channel] leave a channel, the current one by default
+        /history [n]     show the last n messages of the current channel
+        /msg nick text   send text to one user only
+        /pgup, /pgdn     scroll back through earlier messages and forward
+        /search [text]   scroll to the last message with text in it, again
+                         for the one before
+        /p               quit
     """
+    global currentChannel
+
+    command, _, argument = input.partition(" ")
+    argument = argument.strip()
+
+    if command == "/join" and argument:
+        send_message(serverSocket, {"type": "join", "channel": argument})
+        currentChannel = argument
+        if argument != DEFAULT_CHANNEL:
+            joinedChannels.add(argument)
+        request_history(serverSocket, currentChannel, historyCount)
+        return True
+    if command == "/part":
+        channel = argument or currentChannel
+        send_message(serverSocket, {"type": "part", "channel": channel})
+        joinedChannels.discard(channel)
+        if channel == currentChannel:
+            currentChannel = DEFAULT_CHANNEL
+        return True
+    if command == "/msg":
+        target, _, text = argument.partition(" ")
+        text = text.strip()
+        if target and text:
+            send_message(serverSocket, {"type": "privmsg", "nick": target, "message": text})
+        else:
+            print_message("*** usage: /msg nick text")
+        return True
+    if command == "/pgup":
+        scroll_up()
+        return True
+    if command == "/pgdn":
+        scroll_down()
+        return True
+    if command == "/search":
+        search_scrollback(argument)
+        return True
+    if command == "/history":
+        count = int(argument) if argument.isdigit() else 20
+        request_history(serverSocket, currentChannel, count)
+        return True
     if input[:2] == "/p":
         sys.exit()
+    return False
 
-def send_message(server, message):
+def request_history(serverSocket, channel, count):
+    """
+        Ask the server to replay the last count messages of a channel.
+    """
+    if count > 0:
+        send_message(serverSocket, {"type": "history", "channel": channel, "count": count})
+
+def send_message(server, message, encoding=None, framing=None):
     """
         Takes a string message, and converts it into bytes and send to the server.
+        Uses the connection's encoding and framing unless told otherwise.
     """
     # Encode Message
-    jsonMessage = json.dumps(message)
-    encodedMessage = jsonMessage.encode()
+    encodedMessage = chat_protocol.encode_payload(message, encoding or wireEncoding)
     # Get and Encode length
     messageSize = len(encodedMessage)
-    encodedMessageSize = messageSize.to_bytes(2, byteorder='big')
+    encodedMessageSize = chat_protocol.encode_length(messageSize, framing or wireFraming)
     # Combine
     fullPacket = encodedMessageSize + encodedMessage
-    
-    server.send(fullPacket)
 
-packet_buffer = b''
+    # The select loop sends it once the socket can take it
+    if clientSelector is not None and server is serverSocket:
+        if server.fileno() == -1:
+            raise OSError("not connected")
+        outgoing.extend(fullPacket)
+        watch_server()
+        return
+
+    with sendLock:
+        server.sendall(fullPacket)
+
+# Splits what the server sends into payloads
+packetDecoder = chat_protocol.FrameDecoder()
 
-def runner(serverSocket):
+def runner():
     """
         Prints incomming messages from the server to the chats UI window.
+        Reconnects when the connection to the server drops.
     """
     
-    global packet_buffer
-    
-    
     while True:
         # Get a message from the server
-        message_packet = get_next_message_packet(packet_buffer, serverSocket)
+        try:
+            payload = get_next_message_payload(serverSocket)
+        except (OSError, ValueError):
+            payload = None
 
-        if message_packet is None:
-            break
+        if payload is not None:
+            try:
+                toChatWindow = handle_packet(payload)
+            except ValueError:
+                # Not the chat protocol, or a broken compression stream
+                payload = None
 
-        # Get the messages type, and its nickname
-        messageDecoded = extract_message(message_packet)
-        messageType = messageDecoded.get("type")
-        messageNick = messageDecoded.get("nick")
-        
-        # Create a message depending on its type
-        if messageType == "join":
-            toChatWindow = f"*** {messageNick} has joined the chat"
-        elif messageType == "leave":
-            toChatWindow = f"*** {messageNick} has left the chat"
-        elif messageType == "chat":
-            message = messageDecoded.get("message")
-            toChatWindow = f"{messageNick}: {message}"
+        if payload is None:
+            serverSocket.close()
+            if nickTaken:
+                print_message("*** not reconnecting, try another nick")
+                return
+            reconnect()
+            continue
 
         # Send the message to the chat winow
-        print_message(toChatWindow)
-        
+        if toChatWindow is not None:
+            print_message(toChatWindow)
 
+def handle_packet(payload):
+    """
+        Act on a payload from the server. Returns the line to show in the
+        chat window for it, or None.
+    """
+    global lastSeq, serverEpoch, resumeToken, tlsSession, retryAfter, nickTaken
+    global reconnectWaits
 
+    # Get the messages type, and its nickname
+    messageDecoded = extract_message(payload)
+    messageType = messageDecoded.get("type")
+    messageNick = messageDecoded.get("nick")
+    messageChannel = messageDecoded.get("channel", DEFAULT_CHANNEL)
 
-def get_next_message_packet(packet_buffer, serverSocket):
-    """
-    Return the next word packet from the stream.
+    # Remember how far we got, replayed history doesn't count and neither
+    # do the broadcasts replayed after the welcome
+    messageSeq = messageDecoded.get("seq")
+    if (type(messageSeq) is int and "time" not in messageDecoded
+            and (lastSeq is None or messageSeq > lastSeq)):
+        lastSeq = messageSeq
+    
+    # Create a message depending on its type
+    if messageType == "ping":
+        # The server checking we are still here
+        try:
+            send_message(serverSocket, {"type": "pong"})
+        except OSError:
+            pass
+        return None
+    elif messageType == "welcome":
+        # Everything after it comes in the framing we asked for
+        packetDecoder.framing = requestedFraming
+        # Really connected, the next reconnect starts with a short wait
+        reconnectWaits = None
+        # Broadcasts after this one are numbered from here
+        resumed = messageDecoded.get("resumed")
+        serverEpoch = messageDecoded.get("epoch")
+        lastSeq = messageDecoded.get("seq")
+        resumeToken = messageDecoded.get("token")
+        # The session ticket comes right after the handshake, so it is
+        # here by now
+        if tlsContext is not None:
+            tlsSession = serverSocket.session
+        if resumed is None:
+            return None
+        if resumed:
+            toChatWindow = "*** reconnected"
+        else:
+            toChatWindow = "*** reconnected, some messages were missed, /history to see them"
+    elif messageType == "join":
+        toChatWindow = f"*** {messageNick} has joined {messageChannel}"
+    elif messageType == "part":
+        toChatWindow = f"*** {messageNick} has left {messageChannel}"
+    elif messageType == "leave":
+        toChatWindow = f"*** {messageNick} has left the chat"
+    elif messageType == "chat":
+        message = messageDecoded.get("message")
+        toChatWindow = f"{messageNick}: {message}"
+        if messageChannel != DEFAULT_CHANNEL:
+            toChatWindow = f"[{messageChannel}] {toChatWindow}"
+        # Replayed history carries the time it was first sent
+        sentTime = messageDecoded.get("time")
+        if isinstance(sentTime, (int, float)):
+            toChatWindow = f"{time.strftime('%H:%M', time.localtime(sentTime))} {toChatWindow}"
+    elif messageType == "privmsg":
+        message = messageDecoded.get("message")
+        toChatWindow = f"[{messageNick} -> {messageDecoded.get('to')}] {message}"
+    elif messageType == "error":
+        toChatWindow = f"*** {messageDecoded.get('message')}"
+        if messageDecoded.get("code") == "nick_taken":
+            # The server hangs up next, there is no point coming back
+            nickTaken = True
+    elif messageType == "shutdown":
+        # The server is going down, it closes the connection once
+        # everything before this is sent
+        retry = messageDecoded.get("retry_after")
+        if isinstance(retry, (int, float)) and 0 <= retry <= MAX_RECONNECT_DELAY:
+            retryAfter = retry
+        toChatWindow = "*** server is restarting"
+    elif messageType == "history":
+        # Marks the end of a replay
+        if not messageDecoded.get("count"):
+            return None
+        toChatWindow = f"*** {messageDecoded.get('count')} earlier messages in {messageChannel}"
+    else:
+        # Unknown payload type, from a newer server
+        return None
+
+    return toChatWindow
 
-    The word packet consists of the encoded word length followed by the
-    UTF-8-encoded word.
+def get_next_message_payload(serverSocket):
+    """
+    Return the next payload from the stream, reading from the socket until
+    one is all there.
 
-    Returns None if there are no more words, i.e. the server has hung
+    Returns None if there are no more payloads, i.e. the server has hung
     up.
     """
     while True:
             # Start checking to see if the full packet is in the buffer
-            if len(packet_buffer) >= 2:
-                packetLength = int.from_bytes(packet_buffer[:2], "big")
-                
-                # Full Packet in buffer, Extract and Return
-                if len(packet_buffer) >= (packetLength + 2):
-                    fullPacket = packet_buffer[:packetLength + 2]
-                    packet_buffer = packet_buffer[packetLength + 2:]
-                    return fullPacket
+            payload = packetDecoder.next_frame()
+            if payload is not None:
+                return payload
             
             # Get new Data from Socket
-            newData = serverSocket.recv(4096)
+            newData = receive_data(serverSocket)
             
             # No new Data recieved, Return None
             if len(newData) == 0:
                 return None
             
-            packet_buffer += newData
+            packetDecoder.feed(newData)
+
+def receive_data(serverSocket):
+    """
+        Return the next data the server sent, b"" once it has hung up. A TLS
+        connection is only read once something is there, and then without
+        blocking under sendLock, so a send never runs at the same time.
+    """
+    if not isinstance(serverSocket, ssl.SSLSocket):
+        return serverSocket.recv(65536)
+
+    while True:
+        if not serverSocket.pending():
+            select.select([serverSocket], [], [])
+        with sendLock:
+            serverSocket.setblocking(False)
+            try:
+                return serverSocket.recv(65536)
+            except ssl.SSLWantReadError:
+                # Only part of a record, or just a session ticket
+                continue
+            finally:
+                serverSocket.setblocking(True)
 
-def extract_message(packet):
+def extract_message(payload):
     """
-    Extract the message from a message packet.
+    Extract the message from a message payload.
 
-    packet: a message packet consisting of the encoded message length
-    followed by the UTF-8 message.
+    payload: the bytes of a message packet after its length prefix.
 
     Returns the message decoded as Python native Data.
     """
 
-    messageBytes = packet[2:]
-    messageDecoded = messageBytes.decode("ISO-8859-1")
-    message = json.loads(messageDecoded)
+    # Compressed or not, JSON or binary, the payload tells which
+    messageBytes = chat_protocol.decompress_payload(payload, wireDecompressor)
+    message = chat_protocol.decode_payload(messageBytes)
     
     return message
 
@@ -0,0 +1,375 @@
+#----------------------------------------------------#
+# Example usage:                                     #
+# python chat_loadgen.py 5732 --clients 2000         #
+# python chat_loadgen.py --server chat_server.py     #
+#   --report run.json --baseline last.json           #
+#----------------------------------------------------#
+
+# Load generator for the chat protocol. Connects thousands of simulated
+# clients from one asyncio process. Some of them chat at a fixed total rate
+# and the rest just listen. Reports end-to-end broadcast latency
+# percentiles and throughput.
+#
+# Every chat message carries the time it was sent, so a client that gets
+# it back knows how long the trip through the server took. Only the
+# observer clients decode what they receive, the others just drain their
+# socket like a real client would, so the load generator itself stays
+# cheap. Everything random comes from --seed, so two runs with the same
+# options send the same traffic.
+#
+# --report writes the options and results as JSON. Given a --baseline
+# report from an earlier run, the latency percentiles and throughput are
+# compared, and the exit status is 1 if one of them got worse by more than
+# --tolerance.
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+
+import chat_protocol
+from chat_bench import raise_fd_limit, free_port, start_server
+from chat_server_async import install_uvloop
+
+
+# Starts every chat message the load generator sends
+MESSAGE_TAG = "lg"
+# Results compared against a baseline: name -> True if bigger is worse
+COMPARED_RESULTS = {
+    "latency_p50_ms": True,
+    "latency_p99_ms": True,
+    "latency_p999_ms": True,
+    "deliveries_per_second": False,
+}
+# Seconds to wait for messages still on their way after the last send
+DRAIN_TIME = 2.0
+# Seconds between the pings every client sends, so the server doesn't drop
+# the ones that only listen as idle
+KEEPALIVE_INTERVAL = 10.0
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="chat_loadgen.py")
+    parser.add_argument("port", type=int, nargs="?",
+        help="port of a running chat server, or use --server")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--server", metavar="SCRIPT",
+        help="start this chat server script on a free port for the run")
+    parser.add_argument("--clients", type=int, default=1000,
+        help="simulated clients")
+    parser.add_argument("--senders", type=int, default=10,
+        help="clients that chat, the rest only listen")
+    parser.add_argument("--observers", type=int, default=50,
+        help="clients that measure latency")
+    parser.add_argument("--rate", type=float, default=100,
+        help="chat messages per second from all the senders together")
+    parser.add_argument("--message-size", type=int, default=80,
+        help="characters in every chat message")
+    parser.add_argument("--duration", type=float, default=10,
+        help="seconds of measured traffic")
+    parser.add_argument("--warmup", type=float, default=2,
+        help="seconds of traffic before measuring starts")
+    parser.add_argument("--connect-concurrency", type=int, default=100,
+        help="most connections being set up at once")
+    parser.add_argument("--encoding", default="json", choices=chat_protocol.ENCODINGS)
+    parser.add_argument("--framing", default="u16", choices=list(chat_protocol.FRAMINGS))
+    parser.add_argument("--compress", choices=chat_protocol.COMPRESSIONS)
+    parser.add_argument("--seed", type=int, default=1,
+        help="seed for the message contents and send times")
+    parser.add_argument("--report", metavar="FILE",
+        help="write the options and results to FILE as JSON")
+    parser.add_argument("--baseline", metavar="FILE",
+        help="compare the results to an earlier --report")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+        help="how much worse than the baseline a result may be, 0.2 is 20%%")
+    parser.add_argument("--no-uvloop", action="store_true")
+    args = parser.parse_args(argv[1:])
+    if args.port is None and args.server is None:
+        parser.error("give the port of a running server or --server")
+    args.senders = max(1, min(args.senders, args.clients))
+    args.observers = max(1, min(args.observers, args.clients))
+    return args
+
+
+class LoadClient:
+    """
+        One simulated client and what it has seen.
+    """
+    __slots__ = ("nick", "reader", "writer", "observer", "latencies", "received")
+
+    def __init__(self, nick, observer):
+        self.nick = nick
+        self.reader = None
+        self.writer = None
+        self.observer = observer
+        # Seconds from send to receive of every measured message
+        self.latencies = []
+        # Measured messages received
+        self.received = 0
+
+
+def encode_packet(message, args, hello=False):
+    """
+        Return a message as a packet in the encoding and framing asked for.
+        The hello itself is always JSON with a u16 length.
+    """
+    if hello:
+        payload = chat_protocol.encode_payload(message)
+        return chat_protocol.encode_length(len(payload)) + payload
+    payload = chat_protocol.encode_payload(message, args.encoding)
+    return chat_protocol.encode_length(len(payload), args.framing) + payload
+
+
+async def connect(client, args, host, port, gate):
+    """
+        Connect a client and say hello.
+    """
+    async with gate:
+        client.reader, client.writer = await asyncio.open_connection(host, port)
+    hello = {"type": "hello", "nick": client.nick}
+    if args.encoding != "json":
+        hello["encoding"] = args.encoding
+    if args.framing != "u16":
+        hello["version"] = 2
+        hello["framing"] = args.framing
+    if args.compress:
+        hello["compress"] = args.compress
+    client.writer.write(encode_packet(hello, args, hello=True))
+
+
+async def listen(client, args, window):
+    """
+        Read everything the server sends a client until the connection is
+        closed. Observers decode the chat messages and record how long the
+        measured ones took to arrive.
+    """
+    buffer = bytearray()
+    # The server switches to the framing asked for after the welcome
+    framing = "u16"
+    decompressor = None
+    if args.compress == "deflate-stream":
+        decompressor = chat_protocol.make_decompressor()
+
+    while True:
+        data = await client.reader.read(65536)
+        if not data:
+            return
+        if not client.observer:
+            continue
+
+        now = time.perf_counter()
+        buffer += data
+        offset = 0
+        while True:
+            header = chat_protocol.decode_length(buffer, offset, framing)
+            if header is None:
+                break
+            packetLength, payloadStart = header
+            if len(buffer) - payloadStart < packetLength:
+                break
+            offset = payloadStart + packetLength
+            payload = chat_protocol.decompress_payload(buffer[payloadStart:offset], decompressor)
+            message = chat_protocol.decode_payload(payload)
+            if message.get("type") == "welcome":
+                framing = args.framing
+
+            text = message.get("message")
+            if message.get("type") != "chat" or not isinstance(text, str):
+                continue
+            fields = text.split(" ", 3)
+            if len(fields) < 3 or fields[0] != MESSAGE_TAG:
+                continue
+            sentAt = int(fields[2]) / 1e9
+            if window[0] <= sentAt < window[1]:
+                client.latencies.append(now - sentAt)
+                client.received += 1
+        del buffer[:offset]
+
+
+async def send(client, args, rate, rng, stopAt, sentTimes):
+    """
+        Send chat messages from a client at rate per second until stopAt,
+        starting at a random point of the first interval so the senders
+        don't all fire together. Every send time is added to sentTimes.
+    """
+    interval = 1 / rate
+    padding = "x" * args.message_size
+    nextSend = time.perf_counter() + rng.uniform(0, interval)
+
+    while nextSend < stopAt:
+        await asyncio.sleep(max(0, nextSend - time.perf_counter()))
+        sentAt = time.perf_counter_ns()
+        text = f"{MESSAGE_TAG} {client.nick} {sentAt} "
+        text += padding[:max(0, args.message_size - len(text))]
+        client.writer.write(encode_packet({"type": "chat", "message": text}, args))
+        sentTimes.append(sentAt / 1e9)
+        # A fixed schedule, so a slow server shows up as latency instead of
+        # a lower send rate
+        nextSend += interval
+
+
+async def keep_alive(clients, args):
+    """
+        Ping the server from every client now and then, until cancelled.
+    """
+    packet = encode_packet({"type": "ping"}, args)
+    while True:
+        await asyncio.sleep(KEEPALIVE_INTERVAL)
+        for client in clients:
+            if not client.writer.is_closing():
+                client.writer.write(packet)
+
+
+async def run_load(args, host, port):
+    """
+        Connect the clients, run the traffic and return the results.
+    """
+    rng = random.Random(args.seed)
+    clients = [LoadClient(f"load{i}", i < args.observers) for i in range(args.clients)]
+    # The senders are picked from the listeners, so observers see the full
+    # fan-out and don't hear their own messages back any sooner
+    senderPicks = rng.sample(range(args.observers, args.clients), args.senders) \
+        if args.clients - args.observers >= args.senders else list(range(args.senders))
+    senders = [clients[i] for i in senderPicks]
+
+    gate = asyncio.Semaphore(args.connect_concurrency)
+    connectStart = time.perf_counter()
+    await asyncio.gather(*(connect(client, args, host, port, gate) for client in clients))
+    connectTime = time.perf_counter() - connectStart
+
+    # Measure between the end of the warmup and the end of the run
+    window = [float("inf"), float("inf")]
+    listeners = [asyncio.create_task(listen(client, args, window)) for client in clients]
+    pinger = asyncio.create_task(keep_alive(clients, args))
+    # Let the joins settle before sending
+    await asyncio.sleep(1)
+
+    start = time.perf_counter()
+    window[0] = start + args.warmup
+    window[1] = window[0] + args.duration
+    sentTimes = []
+    perSender = args.rate / len(senders)
+    await asyncio.gather(*(send(client, args, perSender, random.Random(rng.random()),
+                                window[1], sentTimes) for client in senders))
+    await asyncio.sleep(DRAIN_TIME)
+
+    pinger.cancel()
+    for client in clients:
+        client.writer.close()
+    await asyncio.gather(*listeners, return_exceptions=True)
+
+    measured = sum(1 for sentAt in sentTimes if window[0] <= sentAt < window[1])
+    observers = [client for client in clients if client.observer]
+    latencies = sorted(latency for client in observers for latency in client.latencies)
+    received = sum(client.received for client in observers)
+
+    results = {
+        "connect_seconds": connectTime,
+        "messages_sent": measured,
+        "send_rate": measured / args.duration,
+        # Every client gets every message, estimated from the observers
+        "deliveries_per_second": received / len(observers) * args.clients / args.duration,
+        "delivered_ratio": received / max(measured * len(observers), 1),
+    }
+    for name, q in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("p999", 0.999)):
+        results[f"latency_{name}_ms"] = percentile(latencies, q) * 1e3
+    results["latency_max_ms"] = (latencies[-1] if latencies else 0) * 1e3
+    results["latency_mean_ms"] = sum(latencies) / max(len(latencies), 1) * 1e3
+    return results
+
+
+def percentile(sortedValues, q):
+    """
+        Return quantile q of a sorted list, 0 for an empty one.
+    """
+    if not sortedValues:
+        return 0
+    return sortedValues[min(int(q * len(sortedValues)), len(sortedValues) - 1)]
+
+
+def make_report(args, results):
+    """
+        Return the options and results of a run as a dictionary.
+    """
+    config = {name: value for name, value in vars(args).items()
+              if name not in ("report", "baseline", "tolerance", "host", "port")}
+    config["python"] = platform.python_version()
+    config["platform"] = platform.platform()
+    config["cpus"] = os.cpu_count()
+    return {"config": config, "results": results}
+
+
+def print_results(results):
+    """
+        Print the results one per line in a fixed order.
+    """
+    for name, value in results.items():
+        print(f"{name:>24}  {value:12.3f}")
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+        Print how the results changed since the baseline and return False
+        if any of them got worse by more than tolerance.
+    """
+    passed = True
+    print(f"{'result':>24}  {'baseline':>12}  {'now':>12}  {'change':>8}")
+    for name, biggerIsWorse in COMPARED_RESULTS.items():
+        before, now = baseline["results"].get(name), results[name]
+        if not before:
+            continue
+        change = now / before - 1
+        worse = change > tolerance if biggerIsWorse else change < -tolerance
+        passed = passed and not worse
+        flag = "  WORSE" if worse else ""
+        print(f"{name:>24}  {before:12.3f}  {now:12.3f}  {change:+8.1%}{flag}")
+    return passed
+
+
+def main(argv):
+    args = parse_args(argv)
+
+    if not args.no_uvloop:
+        install_uvloop()
+    limit = raise_fd_limit()
+    if limit < args.clients + 64:
+        print(f"open file limit {limit} is too low for {args.clients} clients", file=sys.stderr)
+        return 1
+
+    port = args.port
+    server = None
+    if args.server:
+        port = free_port()
+        server = start_server(args.server, port)
+    try:
+        results = asyncio.run(run_load(args, args.host, port))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    print(f"{args.clients} clients, {args.senders} senders, {args.rate:g} messages/s, "
+          f"{args.duration:g}s")
+    print_results(results)
+
+    report = make_report(args, results)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["config"] != report["config"]:
+            print("warning: the baseline was run with other options", file=sys.stderr)
+        if not compare_to_baseline(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
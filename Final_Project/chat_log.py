@@ -0,0 +1,311 @@
+# Append-only message log for the chat server.
+#
+# Chat messages are appended to segment files in a log directory, named
+# after the sequence number of their first record so they sort in order:
+#   segment-00000000000000000001.log
+#
+# Every record is a u32 length prefix followed by a JSON payload:
+#   {"seq": 17, "time": 1700000000.5, "channel": "#lobby", "message": {...}}
+#
+# Records are collected in memory as they are logged and written with one
+# write() per event loop round by commit_log(), so logging never costs the
+# loop a system call per message. fsync() runs at most once every
+# FSYNC_INTERVAL seconds, the OS writes the rest back on its own time.
+#
+# The index kept in memory has the sequence number, timestamp and file
+# location of every record, per channel, so the last N messages of a
+# channel are found without reading the log.
+
+import os
+import time
+import bisect
+
+import chat_protocol
+
+
+# Record framing, records can hold a client's largest payload
+RECORD_FRAMING = "u32"
+# Start a new segment once the current one is this big
+SEGMENT_SIZE = 16 * 1024 * 1024
+# Most seconds between fsync() calls, None to leave it to the OS
+FSYNC_INTERVAL = 1.0
+# Records in one segment at most this many bytes apart are read with one
+# pread(), the other channels' records between them included
+READ_GAP = 4096
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".log"
+
+# Directory the log is in, None while no log is open
+logDirectory = None
+# Oldest segments are deleted past this many, None to keep them all
+maxSegments = None
+# First sequence number of every segment -> its file descriptor, oldest first
+segmentFiles = {}
+# First sequence number of the segment being appended to
+activeSegment = None
+# Bytes in the active segment, committed or not
+activeSize = 0
+# Records logged but not written yet
+pendingRecords = bytearray()
+# Sequence number the next record gets
+nextSeq = 1
+# When the log was last fsync()ed
+lastSync = 0.0
+# Per channel index: channel -> (seqs, times, locations), the locations
+# are (segment, offset, length) of the record's payload
+channelIndex = {}
+
+
+def open_log(directory, segmentLimit=None):
+    """
+        Open the log in a directory, creating it if needed, and rebuild the
+        index from the segments already there. A record cut short by a
+        crash is dropped from the end of the last segment.
+    """
+    global logDirectory, maxSegments, activeSegment, activeSize, nextSeq, lastSync
+
+    close_log()
+    os.makedirs(directory, exist_ok=True)
+    logDirectory = directory
+    maxSegments = segmentLimit
+    lastSync = time.monotonic()
+
+    for firstSeq in sorted(list_segments(directory)):
+        path = segment_path(firstSeq)
+        segmentFiles[firstSeq] = os.open(path, os.O_RDWR | os.O_APPEND)
+        activeSegment = firstSeq
+        activeSize = load_segment(firstSeq)
+
+    if activeSegment is None:
+        start_segment()
+    else:
+        # Carry on after the newest record
+        nextSeq = max(nextSeq, activeSegment)
+        if activeSize >= SEGMENT_SIZE:
+            start_segment()
+
+
+def close_log():
+    """
+        Write what is pending and close the log, if one is open.
+    """
+    global logDirectory, activeSegment, activeSize, nextSeq
+
+    if logDirectory is None:
+        return
+
+    commit_log(sync=True)
+    for fd in segmentFiles.values():
+        os.close(fd)
+    segmentFiles.clear()
+    channelIndex.clear()
+    logDirectory = None
+    activeSegment = None
+    activeSize = 0
+    nextSeq = 1
+
+
+def log_message(message, channel):
+    """
+        Add a message sent to a channel to the log. Returns its sequence
+        number, or None if no log is open. The record is written by the
+        next commit_log().
+    """
+    global nextSeq, activeSize
+
+    if logDirectory is None:
+        return None
+
+    seq = nextSeq
+    nextSeq += 1
+    now = time.time()
+    record = {"seq": seq, "time": now, "channel": channel, "message": message}
+    payload = chat_protocol.encode_payload(record)
+    prefix = chat_protocol.encode_length(len(payload), RECORD_FRAMING)
+
+    pendingRecords.extend(prefix)
+    pendingRecords.extend(payload)
+    add_to_index(channel, seq, now, (activeSegment, activeSize + len(prefix), len(payload)))
+    activeSize += len(prefix) + len(payload)
+
+    if activeSize >= SEGMENT_SIZE:
+        commit_log()
+        start_segment()
+    return seq
+
+
+def commit_log(sync=False):
+    """
+        Write every pending record in one go. Called once per event loop
+        round, so the records of a whole round share one write. fsync()s
+        too if sync is True or FSYNC_INTERVAL has passed.
+    """
+    global lastSync
+
+    if logDirectory is None:
+        return
+
+    fd = segmentFiles[activeSegment]
+    if pendingRecords:
+        with memoryview(pendingRecords) as view:
+            written = 0
+            while written < len(view):
+                written += os.write(fd, view[written:])
+        del pendingRecords[:]
+
+    now = time.monotonic()
+    if sync or (FSYNC_INTERVAL is not None and now - lastSync >= FSYNC_INTERVAL):
+        os.fsync(fd)
+        lastSync = now
+
+
+def read_history(channel, count, since=None):
+    """
+        Return up to count of the newest records logged to a channel, oldest
+        first, leaving out those older than the timestamp since. Every
+        segment involved is read with a single pread().
+    """
+    if logDirectory is None or count <= 0 or channel not in channelIndex:
+        return []
+
+    seqs, times, locations = channelIndex[channel]
+    start = max(len(seqs) - count, 0)
+    if since is not None:
+        start = max(start, bisect.bisect_left(times, since))
+    return read_records(locations[start:])
+
+
+
+# ---- Functions to read and write segments -----
+def segment_path(firstSeq):
+    """
+        Return the file name of the segment starting at firstSeq.
+    """
+    return os.path.join(logDirectory, f"{SEGMENT_PREFIX}{firstSeq:020d}{SEGMENT_SUFFIX}")
+
+
+def list_segments(directory):
+    """
+        Return the first sequence number of every segment in a directory.
+    """
+    segments = []
+    for name in os.listdir(directory):
+        if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+            number = name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]
+            if number.isdigit():
+                segments.append(int(number))
+    return segments
+
+
+def start_segment():
+    """
+        Start appending to a new segment, and delete the oldest ones past
+        maxSegments.
+    """
+    global activeSegment, activeSize
+
+    path = segment_path(nextSeq)
+    segmentFiles[nextSeq] = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+    activeSegment = nextSeq
+    activeSize = 0
+
+    while maxSegments is not None and len(segmentFiles) > maxSegments:
+        drop_segment(next(iter(segmentFiles)))
+
+
+def drop_segment(firstSeq):
+    """
+        Delete a segment and take its records out of the index. A segment
+        only ever holds the oldest records of every channel, so they are at
+        the front of the index.
+    """
+    os.close(segmentFiles.pop(firstSeq))
+    os.unlink(segment_path(firstSeq))
+
+    for channel in list(channelIndex):
+        seqs, times, locations = channelIndex[channel]
+        dropped = 0
+        while dropped < len(locations) and locations[dropped][0] == firstSeq:
+            dropped += 1
+        if dropped == len(seqs):
+            del channelIndex[channel]
+        elif dropped:
+            del seqs[:dropped], times[:dropped], locations[:dropped]
+
+
+def load_segment(firstSeq):
+    """
+        Index every record in a segment and return its size. A partial or
+        unreadable record ends the segment and is cut off.
+    """
+    global nextSeq
+
+    fd = segmentFiles[firstSeq]
+    data = os.pread(fd, os.fstat(fd).st_size, 0)
+    offset = 0
+    while True:
+        try:
+            header = chat_protocol.decode_length(data, offset, RECORD_FRAMING)
+            if header is None:
+                break
+            length, payloadStart = header
+            if len(data) - payloadStart < length:
+                break
+            record = chat_protocol.decode_payload(data[payloadStart:payloadStart + length])
+            seq, channel = record["seq"], record["channel"]
+            add_to_index(channel, seq, record["time"], (firstSeq, payloadStart, length))
+        except (ValueError, KeyError, TypeError):
+            break
+        nextSeq = max(nextSeq, seq + 1)
+        offset = payloadStart + length
+
+    if offset < len(data):
+        os.ftruncate(fd, offset)
+    return offset
+
+
+def add_to_index(channel, seq, timestamp, location):
+    """
+        Add a record's place in the log to its channel's index.
+    """
+    entry = channelIndex.get(channel)
+    if entry is None:
+        entry = channelIndex[channel] = ([], [], [])
+    seqs, times, locations = entry
+    seqs.append(seq)
+    times.append(timestamp)
+    locations.append(location)
+
+
+def read_records(locations):
+    """
+        Return the records at the given locations. Records close together
+        in a segment are read with one pread(), so a quiet channel in a
+        busy segment doesn't read everything logged between its records.
+    """
+    if not locations:
+        return []
+    # Records still waiting for commit_log() aren't in the file yet
+    if pendingRecords:
+        commit_log()
+
+    records = []
+    i = 0
+    while i < len(locations):
+        segment, spanStart, length = locations[i]
+        spanEnd = spanStart + length
+        j = i + 1
+        while j < len(locations):
+            nextSegment, offset, length = locations[j]
+            if nextSegment != segment or offset - spanEnd > READ_GAP:
+                break
+            spanEnd = offset + length
+            j += 1
+        span = memoryview(os.pread(segmentFiles[segment], spanEnd - spanStart, spanStart))
+        for _, offset, length in locations[i:j]:
+            start = offset - spanStart
+            records.append(chat_protocol.decode_payload(span[start:start + length]))
+        i = j
+    return records
+
+# ---- End of Functions to read and write segments -----
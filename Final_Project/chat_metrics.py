@@ -0,0 +1,167 @@
+# Counters, gauges and histograms for the chat server.
+#
+# Updating a metric is a dictionary update, cheap enough to leave on all the
+# time. Gauges are functions that are only called when the metrics are read,
+# so something like the total bytes queued for every client costs nothing
+# until somebody asks for it.
+#
+# render() returns everything in the Prometheus text format, snapshot() as a
+# dictionary for the "stats" payload and the benchmarks.
+
+import time
+import bisect
+
+
+# Bucket upper bounds in seconds for the latency histograms
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# Metric name -> (kind, help text, label name or None), in definition order
+metricInfo = {}
+# Counter values: name or (name, label value) -> number
+counters = {}
+# Gauge name -> function returning its value
+gauges = {}
+# Histogram name -> [bucket bounds, bucket counts, sum, count], the last
+# bucket count is for values past every bound
+histograms = {}
+# When the metrics were last reset
+startTime = time.time()
+
+
+def define_counter(name, help, labelName=None):
+    """
+        Add a counter that starts at 0. A counter with a labelName keeps a
+        separate count for every label value.
+    """
+    metricInfo[name] = ("counter", help, labelName)
+    if labelName is None:
+        counters.setdefault(name, 0)
+
+
+def define_gauge(name, help, function):
+    """
+        Add a gauge whose value is whatever function() returns when the
+        metrics are read.
+    """
+    metricInfo[name] = ("gauge", help, None)
+    gauges[name] = function
+
+
+def define_histogram(name, help, buckets=LATENCY_BUCKETS):
+    """
+        Add a histogram with the given bucket upper bounds.
+    """
+    metricInfo[name] = ("histogram", help, None)
+    histograms[name] = [tuple(buckets), [0] * (len(buckets) + 1), 0.0, 0]
+
+
+def inc(name, amount=1, label=None):
+    """
+        Add amount to a counter, and to its count for label if it has one.
+    """
+    key = name if label is None else (name, label)
+    counters[key] = counters.get(key, 0) + amount
+
+
+def observe(name, value):
+    """
+        Count a value in a histogram.
+    """
+    histogram = histograms[name]
+    histogram[1][bisect.bisect_left(histogram[0], value)] += 1
+    histogram[2] += value
+    histogram[3] += 1
+
+
+def get_counter(name, label=None):
+    """
+        Return a counter's value, or its count for label.
+    """
+    return counters.get(name if label is None else (name, label), 0)
+
+
+def reset():
+    """
+        Set every counter and histogram back to zero.
+    """
+    global startTime
+
+    for key in list(counters):
+        if isinstance(key, tuple):
+            del counters[key]
+        else:
+            counters[key] = 0
+    for histogram in histograms.values():
+        histogram[1] = [0] * len(histogram[1])
+        histogram[2] = 0.0
+        histogram[3] = 0
+    startTime = time.time()
+
+
+def quantile(name, q):
+    """
+        Return an estimate of quantile q of a histogram: the upper bound of
+        the bucket it falls in, or None if nothing was counted.
+    """
+    bounds, bucketCounts, total, count = histograms[name]
+    if not count:
+        return None
+    rank = q * count
+    seen = 0
+    for bound, bucketCount in zip(bounds + (float("inf"),), bucketCounts):
+        seen += bucketCount
+        if seen >= rank:
+            return bound
+    return float("inf")
+
+
+def snapshot():
+    """
+        Return every metric as a dictionary. Labelled counters are
+        dictionaries of label value -> count, histograms have their count,
+        sum and estimated p50 and p99.
+    """
+    stats = {"uptime_seconds": time.time() - startTime}
+    for name, (kind, help, labelName) in metricInfo.items():
+        if kind == "counter" and labelName is None:
+            stats[name] = counters.get(name, 0)
+        elif kind == "counter":
+            stats[name] = {key[1]: value for key, value in counters.items()
+                           if isinstance(key, tuple) and key[0] == name}
+        elif kind == "gauge":
+            stats[name] = gauges[name]()
+        else:
+            bounds, bucketCounts, total, count = histograms[name]
+            stats[name] = {"count": count, "sum": total,
+                           "p50": quantile(name, 0.5), "p99": quantile(name, 0.99)}
+    return stats
+
+
+def render():
+    """
+        Return every metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for name, (kind, help, labelName) in metricInfo.items():
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "counter" and labelName is None:
+            lines.append(f"{name} {counters.get(name, 0)}")
+        elif kind == "counter":
+            for key, value in counters.items():
+                if isinstance(key, tuple) and key[0] == name:
+                    label = str(key[1]).replace("\\", "\\\\").replace('"', '\\"')
+                    lines.append(f'{name}{{{labelName}="{label}"}} {value}')
+        elif kind == "gauge":
+            lines.append(f"{name} {gauges[name]()}")
+        else:
+            bounds, bucketCounts, total, count = histograms[name]
+            seen = 0
+            for bound, bucketCount in zip(bounds, bucketCounts):
+                seen += bucketCount
+                lines.append(f'{name}_bucket{{le="{bound}"}} {seen}')
+            lines.append(f'{name}_bucket{{le="+Inf"}} {count}')
+            lines.append(f"{name}_sum {total}")
+            lines.append(f"{name}_count {count}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,459 @@
+# Payload encodings shared by the chat server and client.
+#
+# Every payload is JSON unless the client asked for the binary encoding in
+# its hello packet. A binary payload starts with a type code below 0x09,
+# a JSON payload with "{" or whitespace, so the receiving end can tell the
+# two apart without keeping any state.
+#
+# Binary payload layout:
+#   1 byte   type code
+#   fields   in the order listed in BINARY_TYPES, each one either
+#              a string: varint (byte length + 1) then the UTF-8 bytes
+#              a number: varint (value + 1)
+#            where a varint of 0 means the field is left out
+#
+# Every packet is a length prefix followed by the payload. The prefix is a
+# 16-bit big-endian number unless the client's hello packet says
+# "version": 2, which switches both directions to the framing named in
+# the hello ("u32" by default) from the next packet on.
+#
+# A client can also ask for compressed payloads from the server with
+# "compress" in its hello. Every payload the server sends it after that
+# starts with a flag byte, RAW_FLAG or DEFLATE_FLAG, followed by the payload
+# as is or raw-deflated. The flag bytes are never the first byte of a JSON
+# or binary payload, so an old server that ignores "compress" still works.
+#   deflate         every payload compressed on its own, so a broadcast is
+#                   compressed once for all clients using it
+#   deflate-stream  one compression context per connection that carries
+#                   over between payloads, like permessage-deflate, so
+#                   repeated nicks and phrases compress well
+
+import json
+import zlib
+
+
+# Encodings a client can ask for in its hello packet
+ENCODINGS = ("json", "binary")
+
+# Length prefix formats: name -> size in bytes, None for a varint
+FRAMINGS = {"u16": 2, "u32": 4, "varint": None}
+# Largest payload each framing can carry
+FRAMING_LIMITS = {"u16": 0xFFFF, "u32": 0xFFFFFFFF, "varint": 0xFFFFFFFF}
+# Framing a version 2 hello gets when it doesn't name one
+DEFAULT_V2_FRAMING = "u32"
+# Longest varint length prefix, enough for FRAMING_LIMITS["varint"]
+MAX_VARINT_BYTES = 5
+
+# Compressions a client can ask for in its hello packet
+COMPRESSIONS = ("deflate", "deflate-stream")
+# First byte of a payload sent with compression on
+RAW_FLAG = 0xC0
+DEFLATE_FLAG = 0xC1
+# zlib level, chat payloads are small so the fast levels gain little
+COMPRESSION_LEVEL = 6
+# Window and memory sizes for payloads compressed on their own. A single
+# payload gains nothing from a big window, and setting up the default 32 KiB
+# one costs ten times as much as compressing a chat line.
+STATELESS_WBITS = 9
+STATELESS_MEM_LEVEL = 1
+# What a sync flush ends with, left off on the wire and put back to decompress
+SYNC_FLUSH_TAIL = b"\x00\x00\xff\xff"
+# Largest payload we are willing to inflate a compressed one to
+MAX_DECOMPRESSED_SIZE = 16 * 1024 * 1024
+
+# Payload types that have a binary form: type -> (code, fields)
+BINARY_TYPES = {
+    "chat": (1, ("nick", "message", "channel", "seq")),
+    "join": (2, ("nick", "channel", "seq")),
+    "part": (3, ("nick", "channel", "seq")),
+    "leave": (4, ("nick", "seq")),
+    "privmsg": (5, ("nick", "to", "message")),
+}
+# Binary type code -> (type, fields)
+BINARY_CODES = {code: (payloadType, fields) for payloadType, (code, fields) in BINARY_TYPES.items()}
+# Field kinds, everything not listed is a string
+NUMBER_FIELDS = frozenset({"seq"})
+# Type codes are all below this, JSON starts with "{" or whitespace (tab
+# and up)
+BINARY_CODE_LIMIT = 0x09
+
+
+def encode_payload(message, encoding="json"):
+    """
+        Return a message dictionary as payload bytes in the given encoding.
+        Messages the binary encoding can't hold fall back to JSON.
+    """
+    if encoding == "binary":
+        payload = encode_binary(message)
+        if payload is not None:
+            return payload
+
+    return json.dumps(message).encode()
+
+
+def decode_payload(payloadBytes):
+    """
+        Return the message dictionary in a payload of either encoding.
+        payloadBytes can be bytes, a bytearray or a memoryview.
+    """
+    if len(payloadBytes) and payloadBytes[0] < BINARY_CODE_LIMIT:
+        return decode_binary(payloadBytes)
+
+    return json.loads(str(payloadBytes, "utf-8"))
+
+
+def make_compressor():
+    """
+        Return a raw deflate compression context for deflate-stream.
+    """
+    return zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+
+def make_decompressor():
+    """
+        Return a raw deflate decompression context for deflate-stream.
+    """
+    return zlib.decompressobj(-zlib.MAX_WBITS)
+
+
+def compress_payload(payload, compressor=None):
+    """
+        Return a payload with its compression flag byte in front. Without a
+        compressor every payload is deflated on its own, and sent raw when
+        that doesn't make it smaller. With a compressor the payload always
+        goes through it, so both ends' contexts stay in step.
+    """
+    if compressor is None:
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -STATELESS_WBITS,
+                                      STATELESS_MEM_LEVEL)
+        deflated = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if len(deflated) - len(SYNC_FLUSH_TAIL) >= len(payload):
+            return bytes((RAW_FLAG,)) + payload
+    else:
+        deflated = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    return bytes((DEFLATE_FLAG,)) + deflated[:-len(SYNC_FLUSH_TAIL)]
+
+
+def decompress_payload(data, decompressor=None):
+    """
+        Return the payload in a compressed one, or data itself if it has no
+        compression flag byte. Use the same decompressor for every payload
+        of a deflate-stream connection. Raises ValueError if it doesn't
+        decompress, like when a deflate-stream lost a payload.
+    """
+    if not len(data) or data[0] not in (RAW_FLAG, DEFLATE_FLAG):
+        return data
+    if data[0] == RAW_FLAG:
+        return data[1:]
+
+    if decompressor is None:
+        decompressor = make_decompressor()
+    try:
+        payload = decompressor.decompress(bytes(data[1:]) + SYNC_FLUSH_TAIL, MAX_DECOMPRESSED_SIZE)
+    except zlib.error as e:
+        raise ValueError(f"compressed payload doesn't decompress: {e}") from None
+    if decompressor.unconsumed_tail:
+        raise ValueError("compressed payload inflates past the size limit")
+    return payload
+
+
+def hello_framing(hello):
+    """
+        Return the framing a hello payload switches to, or None if it asks
+        for one we don't know.
+    """
+    version = hello.get("version", 1)
+    if type(version) is not int or version not in (1, 2):
+        return None
+    if version == 1:
+        return "u16"
+
+    framing = hello.get("framing", DEFAULT_V2_FRAMING)
+    if not isinstance(framing, str) or framing not in FRAMINGS:
+        return None
+    return framing
+
+
+def encode_length(size, framing="u16"):
+    """
+        Return the length prefix for a payload of size bytes. Raises
+        OverflowError if the framing can't carry a payload that big.
+    """
+    if size > FRAMING_LIMITS[framing]:
+        raise OverflowError(f"{size} byte payload is too big for {framing} framing")
+
+    prefixSize = FRAMINGS[framing]
+    if prefixSize is not None:
+        return size.to_bytes(prefixSize, "big")
+
+    out = bytearray()
+    write_varint(out, size)
+    return bytes(out)
+
+
+def decode_length(data, offset, framing="u16"):
+    """
+        Return the payload length in the prefix at offset and where the
+        payload starts, or None if the prefix isn't all there yet.
+    """
+    prefixSize = FRAMINGS[framing]
+    if prefixSize is not None:
+        payloadStart = offset + prefixSize
+        if len(data) < payloadStart:
+            return None
+        return int.from_bytes(data[offset:payloadStart], "big"), payloadStart
+
+    # Varint, stop at its last byte or at the end of the data
+    end = min(len(data), offset + MAX_VARINT_BYTES)
+    for i in range(offset, end):
+        if data[i] < 0x80:
+            return read_varint(data, offset)
+    if end - offset == MAX_VARINT_BYTES:
+        raise ValueError("varint length prefix is too long")
+    return None
+
+
+class FrameDecoder:
+    """
+        Splits a stream of length prefixed packets back into payloads.
+        Received bytes are fed in as they come, complete payloads come out
+        and a partial packet waits for the rest.
+
+        The bytes are kept in one bytearray with an offset to the first one
+        not read yet, so taking a packet off the front never moves what is
+        behind it. The read bytes are dropped once they are at least half
+        the buffer, so every byte is moved at most once more on average.
+
+        framing can be changed between packets, like after a hello. A
+        packet longer than maxFrame raises ValueError as soon as its length
+        prefix is in, so its payload is never buffered.
+    """
+    __slots__ = ("framing", "maxFrame", "buffer", "offset")
+
+    def __init__(self, framing="u16", maxFrame=None):
+        self.framing = framing
+        self.maxFrame = maxFrame
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def __len__(self):
+        """
+            Return how many bytes are waiting for the rest of their packet.
+        """
+        return len(self.buffer) - self.offset
+
+    def feed(self, data):
+        """
+            Add received bytes to the end of the stream.
+        """
+        if self.offset and self.offset * 2 >= len(self.buffer):
+            del self.buffer[:self.offset]
+            self.offset = 0
+        self.buffer += data
+
+    def next_frame(self):
+        """
+            Return a copy of the next complete payload as a bytearray, or
+            None if it isn't all here yet.
+        """
+        buffer = self.buffer
+        frame = self.frame_end(buffer, self.offset)
+        if frame is None:
+            return None
+        payloadStart, end = frame
+        payload = buffer[payloadStart:end]
+        if end == len(buffer):
+            del buffer[:]
+            self.offset = 0
+        else:
+            self.offset = end
+        return payload
+
+    def __iter__(self):
+        """
+            Return every complete payload, as next_frame() does.
+        """
+        while True:
+            payload = self.next_frame()
+            if payload is None:
+                return
+            yield payload
+
+    def decode(self, data, function=decode_payload, stop=None):
+        """
+            Feed data and return function(payload) for every complete
+            payload. The payload is a memoryview only valid during the call,
+            so nothing is copied that function doesn't copy itself. When
+            nothing was waiting the packets are read straight out of data,
+            and only a trailing partial one is kept.
+
+            Stops after the first result stop(result) is true for, leaving
+            the rest for the next call, so the framing can be changed first.
+        """
+        if len(self):
+            self.feed(data)
+            source = self.buffer
+            offset = self.offset
+        else:
+            source = data
+            offset = 0
+
+        results = []
+        frame_end = self.frame_end
+        with memoryview(source) as view:
+            while True:
+                frame = frame_end(view, offset)
+                if frame is None:
+                    break
+                payloadStart, offset = frame
+                result = function(view[payloadStart:offset])
+                results.append(result)
+                if stop is not None and stop(result):
+                    break
+
+        if source is data:
+            # Whatever is left goes into the emptied buffer
+            self.advance(len(self.buffer))
+            self.buffer += data[offset:]
+        else:
+            self.advance(offset)
+        return results
+
+    def frame_end(self, data, offset):
+        """
+            Return where the payload of the packet at offset starts and
+            ends, or None if the packet isn't all there yet.
+        """
+        if self.framing == "u16":
+            # What nearly every client uses, read without slicing
+            payloadStart = offset + 2
+            if len(data) < payloadStart:
+                return None
+            packetLength = data[offset] << 8 | data[offset + 1]
+        else:
+            header = decode_length(data, offset, self.framing)
+            if header is None:
+                return None
+            packetLength, payloadStart = header
+        if self.maxFrame is not None and packetLength > self.maxFrame:
+            raise ValueError(f"{packetLength} byte packet is over the {self.maxFrame} byte limit")
+        end = payloadStart + packetLength
+        if len(data) < end:
+            return None
+        return payloadStart, end
+
+    def advance(self, offset):
+        """
+            Mark the buffer read up to offset, emptying it once it is all
+            read.
+        """
+        if offset >= len(self.buffer):
+            del self.buffer[:]
+            self.offset = 0
+        else:
+            self.offset = offset
+
+
+def encode_binary(message):
+    """
+        Return a message in the binary encoding, or None if it has a type or
+        field the binary encoding doesn't know.
+    """
+    binaryType = BINARY_TYPES.get(message.get("type"))
+    if binaryType is None:
+        return None
+    code, fields = binaryType
+
+    out = bytearray((code,))
+    # Keys written so far, the type included
+    written = 1
+    for field in fields:
+        value = message.get(field)
+        if value is None:
+            out.append(0)
+            continue
+        written += 1
+        if field in NUMBER_FIELDS:
+            if type(value) is not int or value < 0:
+                return None
+            write_varint(out, value + 1)
+        else:
+            if type(value) is not str:
+                return None
+            encoded = value.encode()
+            size = len(encoded) + 1
+            if size < 0x80:
+                out.append(size)
+            else:
+                write_varint(out, size)
+            out += encoded
+
+    # Every key must have had a slot
+    if written != len(message):
+        return None
+
+    return bytes(out)
+
+
+def decode_binary(payloadBytes):
+    """
+        Return the message dictionary in a binary payload.
+    """
+    binaryType = BINARY_CODES.get(payloadBytes[0])
+    if binaryType is None:
+        raise ValueError(f"unknown binary payload type {payloadBytes[0]}")
+    payloadType, fields = binaryType
+
+    message = {"type": payloadType}
+    offset = 1
+    for field in fields:
+        # Most fields are shorter than 127 bytes, so read one byte numbers
+        # without a function call
+        if offset >= len(payloadBytes):
+            raise ValueError("binary payload ends inside a number")
+        value = payloadBytes[offset]
+        if value < 0x80:
+            offset += 1
+        else:
+            value, offset = read_varint(payloadBytes, offset)
+        if value == 0:
+            continue
+        if field in NUMBER_FIELDS:
+            message[field] = value - 1
+        else:
+            end = offset + value - 1
+            if end > len(payloadBytes):
+                raise ValueError("binary payload field runs past the end")
+            message[field] = str(payloadBytes[offset:end], "utf-8")
+            offset = end
+
+    return message
+
+
+def write_varint(out, value):
+    """
+        Append an unsigned number to a bytearray, 7 bits per byte, low bits
+        first, high bit set on every byte but the last.
+    """
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(view, offset):
+    """
+        Return the unsigned number at offset and the offset after it.
+    """
+    value = 0
+    shift = 0
+    while True:
+        if offset >= len(view):
+            raise ValueError("binary payload ends inside a number")
+        byte = view[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
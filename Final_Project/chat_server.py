@@ -3,167 +3,945 @@
 # python chat_server.py 5732     #
 #--------------------------------#
 
+import os
 import sys
+import time
+import hmac
+import heapq
+import random
+import signal
 import socket
-import select
-import json
+import secrets
+import ssl
+import selectors
+import argparse
+from itertools import islice
+from collections import deque
 
+import chat_protocol
+import chat_log
+import chat_metrics
 
 
-# Packet Size
+
+# Packet Size, before a version 2 hello picks another framing
 PACKET_LEN_SIZE = 2
-# A set to keep track of all the socket connections
-socketSet = set()
-# Buffer for Byte data sent by Clients
-recvBuffer = {}
-# Client Aliases
-clientAlias = {}
+# Largest payload a client may send, larger packets get it dropped before
+# the payload is read
+MAX_FRAME_SIZE = 1024 * 1024
+# Channel every client joins when it says hello, and the one chat messages
+# without a channel go to
+DEFAULT_CHANNEL = "#lobby"
+# Longest channel name a client may join
+MAX_CHANNEL_NAME = 64
+# Messages replayed for a history request that doesn't say how many, and
+# the most it may ask for
+HISTORY_COUNT = 50
+MAX_HISTORY_COUNT = 1000
+# Newest broadcasts kept for clients that reconnect and resume
+REPLAY_BUFFER_SIZE = 4096
+# Payload types counted by name in the metrics, anything else is "other"
+PAYLOAD_TYPES = ("hello", "chat", "privmsg", "join", "part", "history", "stats", "ping", "pong")
+# Seconds a client may stay silent before it is pinged, and then how long
+# it has to answer before it is dropped
+PING_INTERVAL = 30.0
+PING_TIMEOUT = 30.0
+# Seconds a new connection has to say hello
+HELLO_TIMEOUT = 10.0
+# Seconds a metrics reader has to send its request and take the answer
+STATS_TIMEOUT = 5.0
+# Token bucket rate limits on what clients send: payloads per second
+# refilled and the most that can be saved up, per connection and per nick.
+# A nick's bucket outlives its connection, so reconnecting doesn't refill
+# it. A rate of 0 turns the limit off.
+RATE_LIMIT = 10.0
+RATE_BURST = 30
+NICK_RATE_LIMIT = 20.0
+NICK_RATE_BURST = 60
+# Seconds between sweeps for the buckets of nicks nobody uses that have
+# filled up again, which are no different from new ones
+NICK_BUCKET_SWEEP_INTERVAL = 60.0
+# What happens to a payload over the limit:
+#   drop:  throw it away
+#   pause: stop reading from the client until it has a token again, so
+#          the kernel's buffers fill up and TCP slows the client down
+THROTTLE_POLICIES = ("drop", "pause")
+THROTTLE_POLICY = "drop"
+# Payloads that never cost a token
+UNLIMITED_PAYLOAD_TYPES = ("hello", "pong")
+# Seconds the queued packets get to go out once the server is told to
+# stop, before the clients are closed anyway
+DRAIN_TIMEOUT = 5.0
+# Clients are told to reconnect after a random delay of up to this many
+# seconds, so a restart doesn't bring every one of them back at once
+RECONNECT_SPREAD = 5.0
+# Seconds a hot restart may take to hand over the listening socket
+HANDOVER_TIMEOUT = 5.0
+# Framing between worker processes, so wrapping a client's largest
+# payload in a broadcast message still fits
+BUS_FRAMING = "u32"
+# Most bytes read from a client in one go
+RECV_SIZE = 65536
+# Most bytes written to a TLS client with one send(), one TLS record
+TLS_SEND_SIZE = 16384
+# Most bytes that may wait in one client's outbound queue
+SEND_HIGH_WATER = 1024 * 1024
+# What to do with a client whose outbound queue passes the high-water mark:
+#   drop-oldest: throw away its oldest queued packets
+#   disconnect:  drop the client
+#   coalesce:    throw away everything queued and keep only the newest packet
+# A deflate-stream client is dropped rather than losing packets, its
+# compression context has already seen them.
+SLOW_CLIENT_POLICIES = ("drop-oldest", "disconnect", "coalesce")
+SLOW_CLIENT_POLICY = "drop-oldest"
+# Most packets handed to one sendmsg() call
+try:
+    SEND_BATCH_SIZE = min(os.sysconf("SC_IOV_MAX"), 1024)
+except (AttributeError, ValueError, OSError):
+    SEND_BATCH_SIZE = 16
+# Event loop backends, best first. DefaultSelector picks epoll on Linux
+# and kqueue on BSD/macOS, select() is the portable fallback.
+SELECTOR_BACKENDS = {
+    "default": selectors.DefaultSelector,
+    "epoll": getattr(selectors, "EpollSelector", None),
+    "kqueue": getattr(selectors, "KqueueSelector", None),
+    "poll": getattr(selectors, "PollSelector", None),
+    "select": selectors.SelectSelector,
+}
+# Selector the sockets are registered with
+selector = None
+# TLS context new connections are wrapped in, None for plaintext
+tlsContext = None
+# Every connected client by file descriptor
+connections = {}
+# Every client that said hello by nick, no two clients share one
+nickIndex = {}
+# Sequence number of the newest broadcast
+broadcastSeq = 0
+# The newest broadcasts as (seq, channels, message), in order with no gaps
+replayBuffer = deque(maxlen=REPLAY_BUFFER_SIZE)
+# Tells this server run's sequence numbers apart from another one's
+serverEpoch = os.urandom(4).hex()
+# Members of every channel
+channelMembers = {}
+# Clients to drop once the current event has been handled
+pendingDisconnects = set()
+# Connections that had packets queued this round and still need a send
+dirtyConnections = set()
+# The other worker processes by file descriptor, when running several
+busPeers = {}
+# Heap of (deadline, tiebreak, action, connection), action(connection,
+# now, listenSocket) is called once deadline has passed. Entries of
+# dropped clients are skipped when they come up.
+deadlineHeap = []
+deadlineCount = 0
+# Token buckets of every nick as [tokens, last refill time], and when
+# the idle ones are swept next
+nickBuckets = {}
+nickBucketSweepAt = 0.0
+# Time at the start of the current event loop round
+loopTime = time.monotonic()
+# Listening socket of the stats endpoint, and its connections as socket
+# -> [deadline, what is left to send them or None before their request]
+statsSocket = None
+statsClients = {}
+# Set by SIGTERM and SIGINT, and when the draining clients have to be
+# closed by
+stopRequested = False
+shutdownDeadline = None
+# Signals are written to wakeupWriter by the interpreter, which wakes up
+# select() waiting on wakeupSocket
+wakeupSocket = None
+wakeupWriter = None
+# Unix socket a new server process connects to for a hot restart, and
+# its path
+controlSocket = None
+controlPath = None
+# Every client is received into this, then only leftovers get copied
+recvScratch = bytearray(RECV_SIZE)
+recvView = memoryview(recvScratch)
+
+
+class Connection:
+    """
+        Everything the server keeps about one client, or about another
+        worker on the bus. It is the data of the socket's selector key, so
+        an event gets to all of it without a lookup.
+    """
+    __slots__ = ("socket", "fd", "decoder", "nick", "encoding", "framing",
+                 "compression", "compressor", "channels", "sendQueue",
+                 "sendQueueBytes", "sendOffset", "events", "connectedAt",
+                 "lastSeen", "pingSent", "bucket", "paused", "heldPayloads",
+                 "tls", "handshake", "tlsChunk", "resumeToken", "isBus", "closed")
+
+    def __init__(self, socket, isBus=False):
+        self.socket = socket
+        self.fd = socket.fileno()
+        # Framing of what it sends us, and of what we send it
+        self.framing = BUS_FRAMING if isBus else "u16"
+        # Splits what it sends into packets, keeps a packet that isn't all
+        # here yet
+        self.decoder = chat_protocol.FrameDecoder(self.framing, None if isBus else MAX_FRAME_SIZE)
+        # None until the client says hello
+        self.nick = None
+        self.encoding = "json"
+        self.compression = None
+        # Compression context of a deflate-stream client
+        self.compressor = None
+        self.channels = set()
+        # Packets waiting to be sent, how many bytes they add up to and how
+        # many bytes of the first one already went out
+        self.sendQueue = deque()
+        self.sendQueueBytes = 0
+        self.sendOffset = 0
+        # Events the socket is registered for, 0 if it isn't
+        self.events = 0
+        # When it connected and last sent anything, and when it was pinged
+        # if it hasn't answered yet
+        self.connectedAt = loopTime
+        self.lastSeen = loopTime
+        self.pingSent = None
+        # Token bucket as [tokens, last refill time], None for no limit
+        self.bucket = None
+        # Reads paused by a rate limit, and the payloads it sent that still
+        # have to wait for a token
+        self.paused = False
+        self.heldPayloads = ()
+        # TLS clients wait for the event their handshake needs next, 0 once
+        # it is done, and keep the bytes a send() has to be retried with
+        self.tls = isinstance(socket, ssl.SSLSocket)
+        self.handshake = selectors.EVENT_READ if self.tls else 0
+        self.tlsChunk = None
+        # Secret sent only to this client in its welcome, a reconnect that
+        # shows it may take over the nick from this connection
+        self.resumeToken = None
+        self.isBus = isBus
+        self.closed = False
+
+
+# Metrics, see chat_metrics.py
+chat_metrics.define_counter("chat_connections_accepted_total", "Client connections accepted")
+chat_metrics.define_counter("chat_connections_closed_total", "Client connections closed")
+chat_metrics.define_gauge("chat_clients", "Connected clients",
+                          lambda: len(connections))
+chat_metrics.define_counter("chat_frames_received_total", "Packets received from clients")
+chat_metrics.define_counter("chat_bytes_received_total", "Bytes received from clients")
+chat_metrics.define_counter("chat_payloads_received_total", "Payloads received by type", "type")
+chat_metrics.define_counter("chat_frames_sent_total", "Packets sent")
+chat_metrics.define_counter("chat_bytes_sent_total", "Bytes sent")
+chat_metrics.define_counter("chat_send_calls_total", "send() and sendmsg() calls")
+chat_metrics.define_counter("chat_broadcasts_total", "Messages broadcast")
+chat_metrics.define_counter("chat_broadcast_deliveries_total", "Packets queued for broadcasts")
+chat_metrics.define_histogram("chat_broadcast_seconds", "Time to queue a broadcast for every recipient")
+chat_metrics.define_histogram("chat_loop_iteration_seconds", "Time to handle one round of ready sockets")
+chat_metrics.define_gauge("chat_send_queue_bytes", "Bytes queued for every client together",
+                          lambda: sum(c.sendQueueBytes for c in connections.values()))
+chat_metrics.define_gauge("chat_send_queue_max_bytes", "Bytes queued for the furthest behind client",
+                          lambda: max((c.sendQueueBytes for c in connections.values()), default=0))
+chat_metrics.define_counter("chat_slow_client_events_total", "Times a client passed the high-water mark")
+chat_metrics.define_counter("chat_pings_sent_total", "Pings sent to silent clients")
+chat_metrics.define_counter("chat_idle_evictions_total", "Clients dropped for not answering or not saying hello")
+chat_metrics.define_counter("chat_throttled_frames_total", "Payloads over a rate limit, by limit", "limit")
+chat_metrics.define_counter("chat_read_pauses_total", "Times reading from a client was paused by a rate limit")
+chat_metrics.define_counter("chat_nick_conflicts_total", "Hellos refused for a nick already in use")
+chat_metrics.define_counter("chat_tls_handshakes_total", "TLS handshakes finished, by session", "session")
+chat_metrics.define_counter("chat_tls_handshake_failures_total", "TLS handshakes that failed")
+chat_metrics.define_histogram("chat_tls_handshake_seconds", "Time from accepting a TLS client to its finished handshake")
+chat_metrics.define_counter("chat_compress_raw_bytes_total", "Payload bytes before compression")
+chat_metrics.define_counter("chat_compress_wire_bytes_total", "Payload bytes after compression")
     
 
-def run_server(port):
+def run_server(port, backend="default", highWater=None, slowPolicy=None,
+               maxFrame=None, logDir=None, logSegments=None, statsPort=None,
+               pingInterval=None, pingTimeout=None, rateLimit=None, rateBurst=None,
+               nickRateLimit=None, nickRateBurst=None, throttlePolicy=None,
+               tls=None, drainTimeout=None, control=None, busSockets=(),
+               reusePort=False):
     """
         Runs the Chat Server. Accepts Packets from Clients then sends Packets to
         all other connected clients based on the packet type.
+
+        Chat messages are kept in a message log in logDir, if one is given.
+        With a statsPort the metrics can be read from that port on localhost.
+        tls is an SSLContext from make_tls_context() to speak TLS with.
+
+        SIGTERM and SIGINT stop it gracefully: it stops accepting, tells
+        the clients to reconnect later and gives their queued packets
+        drainTimeout seconds to go out, then returns. With a control
+        socket path a new server process started with the same path takes
+        over the listening socket from this one, see take_over().
+
+        busSockets connect this server to the other workers of a multi-process
+        server, see run_workers().
     """
+    global SEND_HIGH_WATER, SLOW_CLIENT_POLICY, MAX_FRAME_SIZE, serverEpoch, loopTime
+    global PING_INTERVAL, PING_TIMEOUT, THROTTLE_POLICY, tlsContext, DRAIN_TIMEOUT
+    global RATE_LIMIT, RATE_BURST, NICK_RATE_LIMIT, NICK_RATE_BURST
+    if highWater is not None:
+        SEND_HIGH_WATER = highWater
+    if slowPolicy is not None:
+        SLOW_CLIENT_POLICY = slowPolicy
+    if maxFrame is not None:
+        MAX_FRAME_SIZE = maxFrame
+    if pingInterval is not None:
+        PING_INTERVAL = pingInterval
+    if pingTimeout is not None:
+        PING_TIMEOUT = pingTimeout
+    if rateLimit is not None:
+        RATE_LIMIT = rateLimit
+    if rateBurst is not None:
+        RATE_BURST = rateBurst
+    if nickRateLimit is not None:
+        NICK_RATE_LIMIT = nickRateLimit
+    if nickRateBurst is not None:
+        NICK_RATE_BURST = nickRateBurst
+    if throttlePolicy is not None:
+        THROTTLE_POLICY = throttlePolicy
+    if drainTimeout is not None:
+        DRAIN_TIMEOUT = drainTimeout
+    tlsContext = tls
     
+    # Pick the event loop backend before any socket is registered
+    set_selector(backend)
+    # Every worker numbers its own broadcasts
+    serverEpoch = os.urandom(4).hex()
+    install_signal_handlers()
+
+    # Take over from the server already running, if there is one. It
+    # closes the message log before handing over.
+    listenSocket = None
+    if control is not None:
+        listenSocket = take_over(control)
+
+    if logDir is not None:
+        chat_log.open_log(logDir, logSegments)
+
     # Create and add the listening socket
-    listenSocket = listen_socket(port)
-    add_to_socket_set(listenSocket)
+    if listenSocket is None:
+        listenSocket = listen_socket(port, reusePort)
+    get_selector().register(listenSocket, selectors.EVENT_READ)
+    if control is not None:
+        listen_control(control)
+
+    if statsPort is not None:
+        listen_stats(statsPort)
+
+    # Connect to the other workers
+    for busSocket in busSockets:
+        add_bus_peer(busSocket)
 
     while True:
-        # Get the list of sockets that are ready to recv or accept from
-        readyToRead, _, _ = select.select(get_socket_set(), {}, {})
-
-        for readySocket in readyToRead:
-            # New connection coming in
-            if readySocket is listenSocket:
-                newConnection = readySocket.accept()
-                # Add socket to the set and create a buffer
-                add_to_socket_set(newConnection[0])
-                add_connection_to_recv_buffer(newConnection[0])
-            else:
-                try:
-                    data = get_data(readySocket)
-                except:
-                    # Client has transmitted that they are disconnecting
-                    transmit_disconnect(readySocket, listenSocket)
-                    remove_from_socket_set(readySocket)
-                    remove_from_recv_buffer(readySocket)
-                    remove_from_client_alias(readySocket)
-                    break
-                    
-                # Get packet buffer
-                packetBuffer = get_buffer_from_recv_buffer(readySocket)
-                # Process the received packet
-                decodedPayload = process_recv(data, packetBuffer)
-                payloadType = get_payload_type(decodedPayload)
-                
-                # Process the Payload
-                if payloadType == "hello":
-                    # Add the alias
-                    alias = decodedPayload["nick"]
-                    add_alias(readySocket, alias)
-                    transmit_connected(readySocket, listenSocket)
-                elif payloadType == "chat":
-                    # Send out the chat to all clients
-                    transmit_message(readySocket, listenSocket, decodedPayload)
+        # Get the sockets that are ready to recv, accept from or send to.
+        # Sockets are registered once, so this only costs as much as the
+        # ready ones. Wake up in time for the next idle check.
+        readyEvents = get_selector().select(next_deadline_timeout())
+        roundStart = time.perf_counter()
+        loopTime = time.monotonic()
+
+        for key, mask in readyEvents:
+            connection = key.data
+            if connection is None:
+                # New connections coming in
+                if key.fileobj is listenSocket:
+                    accept_connections(listenSocket)
+                # A signal arrived
+                elif key.fileobj is wakeupSocket:
+                    drain_wakeups()
+                # A new server process taking over
+                elif key.fileobj is controlSocket:
+                    hand_over(listenSocket)
+                # Somebody reading the metrics
                 else:
-                    # Invalid Payload Type
-                    pass
-                
+                    process_stats_event(key.fileobj)
+                continue
+            # Broadcasts from the other workers
+            if connection.isBus:
+                process_bus_events(connection, mask, listenSocket)
+                continue
+            # Dropped earlier in this same round
+            if connection.closed or connection in pendingDisconnects:
+                continue
+            # TLS client still shaking hands
+            if connection.handshake:
+                continue_handshake(connection, listenSocket)
+                continue
+
+            # Client can take more of its queued packets
+            if mask & selectors.EVENT_WRITE:
+                flush_send_queue(connection)
+
+            if mask & selectors.EVENT_READ:
+                receive_packets(connection, listenSocket)
+
+        # Ping or drop the clients that have gone quiet, and go on reading
+        # from throttled ones
+        process_deadlines(listenSocket)
+        if statsClients:
+            drop_late_stats_clients()
+
+        # Send everything broadcast this round, several packets per call,
+        # and drop clients that hung up or fell too far behind
+        flush_round(listenSocket)
+        # Write the round's chat messages to the log in one go
+        chat_log.commit_log()
+        chat_metrics.observe("chat_loop_iteration_seconds", time.perf_counter() - roundStart)
+
+        # Stop once every client got what was queued for it
+        if stopRequested and shutdownDeadline is None:
+            begin_shutdown(listenSocket)
+        if shutdownDeadline is not None and drain_clients(listenSocket):
+            end_shutdown()
+            return
+
+
+def accept_connections(listenSocket):
+    """
+        Accept every connection waiting on the listening socket, so a burst
+        of new clients doesn't overflow the accept backlog.
+    """
+    while True:
+        try:
+            newConnection = listenSocket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        chat_metrics.inc("chat_connections_accepted_total")
+        # Sends must never block the loop
+        newConnection[0].setblocking(False)
+        if tlsContext is not None:
+            # The handshake is driven by the event loop like everything else
+            newConnection = (tlsContext.wrap_socket(newConnection[0], server_side=True,
+                                                    do_handshake_on_connect=False),
+                             newConnection[1])
+        connection = add_connection(newConnection[0])
+        # It has HELLO_TIMEOUT to say hello, first checked then or when it
+        # would first need a ping, whichever comes first
+        add_deadline(connection, loopTime + min(HELLO_TIMEOUT, PING_INTERVAL),
+                     check_idle_client)
+
+
+def receive_packets(connection, listenSocket):
+    """
+        Read what a client sent and act on every complete packet in it.
+        A TLS socket can hold decrypted data select() doesn't know about,
+        so it is read until that is gone too.
+    """
+    while True:
+        try:
+            data = get_data(connection.socket)
+        except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        except OSError:
+            # Client has disconnected
+            schedule_disconnect(connection)
+            return
+
+        # Anything at all shows the client is still there
+        connection.lastSeen = loopTime
+        chat_metrics.inc("chat_bytes_received_total", len(data))
+        # Nothing is acted on any more while shutting down
+        if shutdownDeadline is not None:
+            return
+
+        process_received(connection, listenSocket, data)
+
+        if (not connection.tls or connection.paused or connection in pendingDisconnects
+                or not connection.socket.pending()):
+            return
+
+
+def process_received(connection, listenSocket, data):
+    """
+        Act on every complete packet in a client's buffer followed by data.
+        Stops early if the client's reads get paused by a rate limit.
+    """
+    while True:
+        try:
+            # Process every complete packet received so far
+            decodedPayloads = process_recv(data, connection.decoder)
+        except ValueError:
+            # Client sent a packet we can't read or won't take
+            schedule_disconnect(connection)
+            return
+
+        chat_metrics.inc("chat_frames_received_total", len(decodedPayloads))
+        if not dispatch_payloads(connection, listenSocket, decodedPayloads):
+            return
+
+        # process_recv() stops after a hello, since it can change the
+        # framing. Read whatever came after it with the new one.
+        if not (decodedPayloads and len(connection.decoder)
+                and is_hello(decodedPayloads[-1])
+                and connection not in pendingDisconnects):
+            return
+        data = b""
+
+
+def dispatch_payloads(connection, listenSocket, payloads):
+    """
+        Act on payloads in order, as far as the client's rate limits allow.
+        Returns False if its reads got paused, the payloads it didn't get
+        to are held until they are resumed.
+    """
+    for i, payload in enumerate(payloads):
+        if not take_token(connection, payload):
+            if THROTTLE_POLICY == "pause":
+                connection.heldPayloads = payloads[i:]
+                pause_reading(connection)
+                return False
+            # Over the limit, dropped
+            continue
+        process_payload(connection, listenSocket, payload)
+    return True
+
+
+def process_payload(connection, listenSocket, decodedPayload):
+    """
+        Act on one payload received from a client.
+    """
+    payloadType = get_payload_type(decodedPayload)
+    chat_metrics.inc("chat_payloads_received_total",
+                     label=payloadType if payloadType in PAYLOAD_TYPES else "other")
+
+    if payloadType == "hello":
+        alias = decodedPayload.get("nick")
+        framing = chat_protocol.hello_framing(decodedPayload)
+        if not isinstance(alias, str) or framing is None:
+            # Can't talk to this client
+            schedule_disconnect(connection)
+            return
+
+        # Nicks are unique, whoever has one keeps it unless the hello is
+        # from its client coming back before we noticed it was gone
+        holder = get_nick_connection(alias)
+        if holder is not None and holder is not connection and is_resuming(holder, decodedPayload):
+            release_nick(holder)
+            schedule_disconnect(holder)
+        elif holder is not None and holder is not connection:
+            send_to_client(connection, {"type": "error", "code": "nick_taken", "nick": alias,
+                                        "message": f"nick {alias} is already in use"})
+            chat_metrics.inc("chat_nick_conflicts_total")
+            # A client that already has a nick just keeps it
+            if connection.nick is None:
+                schedule_disconnect(connection)
+            return
+
+        # Set the alias and put the client in the default channel, and back
+        # in the channels it was in if it is reconnecting
+        if connection.nick is not None:
+            release_nick(connection)
+        add_nick(connection, alias)
+        start_rate_limits(connection, alias)
+        set_encoding(connection, decodedPayload.get("encoding"))
+        connection.decoder.framing = framing
+        set_compression(connection, decodedPayload.get("compress"))
+        channels = get_hello_channels(decodedPayload)
+        welcome_client(connection, decodedPayload, channels, framing)
+        for channel in channels:
+            join_channel(connection, channel, listenSocket)
+    elif payloadType == "ping":
+        send_to_client(connection, {"type": "pong"})
+    elif payloadType == "pong":
+        # Receiving it was enough to count as activity
+        pass
+    elif connection.nick is None:
+        # Everything else needs a hello first
+        pass
+    elif payloadType == "chat":
+        # Send out the chat to the channel's members
+        transmit_message(connection, listenSocket, decodedPayload)
+    elif payloadType == "privmsg":
+        # Straight to one client, never through the broadcast path
+        send_private_message(connection, decodedPayload)
+    elif payloadType == "join":
+        channel = get_channel_name(decodedPayload)
+        if channel is not None:
+            join_channel(connection, channel, listenSocket)
+    elif payloadType == "part":
+        channel = get_channel_name(decodedPayload)
+        if channel is not None:
+            part_channel(connection, channel, listenSocket)
+    elif payloadType == "history":
+        send_history(connection, decodedPayload)
+    elif payloadType == "stats":
+        send_to_client(connection, {"type": "stats", "metrics": chat_metrics.snapshot()})
+    else:
+        # Invalid Payload Type
+        pass
+
+
+def disconnect_client(leaving, listenSocket):
+    """
+        Tell everyone a client left and forget everything about it.
+    """
+    remove_connection(leaving)
+    dirtyConnections.discard(leaving)
+    # The leave goes to the channels the client was in, but not to itself
+    channels = leaving.channels
+    remove_from_all_channels(leaving)
+    transmit_disconnect(leaving, listenSocket, channels)
+    if leaving.nick is not None:
+        release_nick(leaving)
+    leaving.socket.close()
+    chat_metrics.inc("chat_connections_closed_total")
+
+
+def schedule_disconnect(connection):
+    """
+        Mark a client to be dropped once the current event is handled. Used
+        where dropping it right away would change the connections under a
+        loop that is walking them.
+    """
+    pendingDisconnects.add(connection)
+
+
+def process_pending_disconnects(listenSocket):
+    """
+        Drop every client marked with schedule_disconnect(). Telling everyone
+        about a leaving client can mark more clients, so keep going until
+        none are left.
+    """
+    while pendingDisconnects:
+        leaving = pendingDisconnects.pop()
+        if not leaving.closed:
+            disconnect_client(leaving, listenSocket)
+
+
+def flush_round(listenSocket):
+    """
+        End of an event loop round: send the queued packets and handle the
+        disconnects. A disconnect broadcasts a leave packet, which dirties
+        more connections, so keep going until both are done.
+    """
+    while dirtyConnections or pendingDisconnects:
+        flush_dirty_connections()
+        process_pending_disconnects(listenSocket)
+
+
+def add_deadline(connection, deadline, action):
+    """
+        Call action(connection, now, listenSocket) once deadline (in
+        time.monotonic() seconds) has passed.
+    """
+    global deadlineCount
+    deadlineCount += 1
+    heapq.heappush(deadlineHeap, (deadline, deadlineCount, action, connection))
+
+
+def next_deadline_timeout():
+    """
+        Return how long select() may wait before the next idle check is
+        due, or the end of a shutdown, or None if there is nothing to wait
+        for.
+    """
+    if shutdownDeadline is not None:
+        return max(0.0, shutdownDeadline - time.monotonic())
+    deadlines = [deadline for deadline, _ in statsClients.values()]
+    if deadlineHeap:
+        deadlines.append(deadlineHeap[0][0])
+    if not deadlines:
+        return None
+    return max(0.0, min(deadlines) - time.monotonic())
+
+
+def process_deadlines(listenSocket):
+    """
+        Act on every deadline that has passed. Activity doesn't touch the
+        heap, so a client that was heard from since its idle check was set
+        just gets a new one counted from then. Every client has one idle
+        check in the heap at a time.
+    """
+    now = time.monotonic()
+    while deadlineHeap and deadlineHeap[0][0] <= now:
+        _, _, action, connection = heapq.heappop(deadlineHeap)
+        if not connection.closed and connection not in pendingDisconnects:
+            action(connection, now, listenSocket)
+
+
+def check_idle_client(connection, now, listenSocket):
+    """
+        Drop a client that never said hello or didn't answer a ping, ping
+        one that has been silent for PING_INTERVAL, and set the time to
+        check on it next.
+    """
+    lastSeen = connection.lastSeen
+    pingSent = connection.pingSent
+
+    if connection.nick is None:
+        deadline = connection.connectedAt + HELLO_TIMEOUT
+    elif pingSent is not None and lastSeen < pingSent:
+        deadline = pingSent + PING_TIMEOUT
+    elif now - lastSeen >= PING_INTERVAL:
+        connection.pingSent = now
+        send_to_client(connection, {"type": "ping"})
+        chat_metrics.inc("chat_pings_sent_total")
+        deadline = now + PING_TIMEOUT
+    else:
+        deadline = lastSeen + PING_INTERVAL
+
+    if deadline <= now:
+        chat_metrics.inc("chat_idle_evictions_total")
+        schedule_disconnect(connection)
+    else:
+        add_deadline(connection, deadline, check_idle_client)
+
+
+def start_rate_limits(connection, alias):
+    """
+        Give a client that said hello a full token bucket, and its nick one
+        unless the nick still has its own from an earlier connection.
+        Saying hello again doesn't refill the client's.
+    """
+    if RATE_LIMIT > 0 and connection.bucket is None:
+        connection.bucket = [RATE_BURST, loopTime]
+    if NICK_RATE_LIMIT > 0 and alias not in nickBuckets:
+        sweep_nick_buckets()
+        nickBuckets[alias] = [NICK_RATE_BURST, loopTime]
+
+
+def sweep_nick_buckets():
+    """
+        Forget the buckets of nicks nobody is using that are full again, at
+        most once every NICK_BUCKET_SWEEP_INTERVAL.
+    """
+    global nickBucketSweepAt
+    if loopTime < nickBucketSweepAt:
+        return
+    nickBucketSweepAt = loopTime + NICK_BUCKET_SWEEP_INTERVAL
 
+    for nick, bucket in list(nickBuckets.items()):
+        if nick not in nickIndex and refill(bucket, NICK_RATE_LIMIT, NICK_RATE_BURST) >= NICK_RATE_BURST:
+            del nickBuckets[nick]
 
-def listen_socket(port):
-    # Creates and returns a listener socket
+
+def refill(bucket, rate, burst):
+    """
+        Add the tokens earned since a bucket was last refilled. Returns the
+        tokens in it.
+    """
+    tokens = min(burst, bucket[0] + (loopTime - bucket[1]) * rate)
+    bucket[0] = tokens
+    bucket[1] = loopTime
+    return tokens
+
+
+def take_token(connection, payload):
+    """
+        Take a token from a client's bucket and its nick's bucket for a
+        payload. Returns False, taking nothing, if either is empty.
+    """
+    if get_payload_type(payload) in UNLIMITED_PAYLOAD_TYPES:
+        return True
+
+    connectionBucket = connection.bucket
+    if connectionBucket is not None and refill(connectionBucket, RATE_LIMIT, RATE_BURST) < 1:
+        chat_metrics.inc("chat_throttled_frames_total", label="connection")
+        return False
+    nickBucket = nickBuckets.get(connection.nick)
+    if nickBucket is not None and refill(nickBucket, NICK_RATE_LIMIT, NICK_RATE_BURST) < 1:
+        chat_metrics.inc("chat_throttled_frames_total", label="nick")
+        return False
+
+    if connectionBucket is not None:
+        connectionBucket[0] -= 1
+    if nickBucket is not None:
+        nickBucket[0] -= 1
+    return True
+
+
+def pause_reading(connection):
+    """
+        Stop reading from a throttled client until both its buckets have a
+        token again.
+    """
+    wait = 0.0
+    if connection.bucket is not None:
+        wait = max(wait, (1 - connection.bucket[0]) / RATE_LIMIT)
+    nickBucket = nickBuckets.get(connection.nick)
+    if nickBucket is not None:
+        wait = max(wait, (1 - nickBucket[0]) / NICK_RATE_LIMIT)
+
+    chat_metrics.inc("chat_read_pauses_total")
+    connection.paused = True
+    update_interest(connection)
+    add_deadline(connection, loopTime + wait, resume_reading)
+
+
+def resume_reading(connection, now, listenSocket):
+    """
+        Act on the payloads a throttled client had waiting, then read from
+        it again, starting with what is left in its buffer.
+    """
+    connection.paused = False
+    heldPayloads, connection.heldPayloads = connection.heldPayloads, ()
+    if not dispatch_payloads(connection, listenSocket, heldPayloads):
+        return
+    update_interest(connection)
+    if len(connection.decoder):
+        process_received(connection, listenSocket, b"")
+    # Decrypted records left in an SSL socket never show up in select()
+    if (connection.tls and not connection.paused and connection not in pendingDisconnects
+            and connection.socket.pending()):
+        receive_packets(connection, listenSocket)
+
+
+def listen_socket(port, reusePort=False):
+    # Creates and returns a listener socket. With reusePort several
+    # processes can listen on the same port and the kernel spreads new
+    # connections between them.
     s = socket.socket()
+    # Restart right away even with the last run's connections in TIME_WAIT,
+    # so reconnecting clients find it
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reusePort:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     s.bind(('', port))
-    s.listen()
+    s.listen(socket.SOMAXCONN)
+    s.setblocking(False)
 
     return s
 
 
 
 # --- Functions to Get / Add / Remove from  variables ---
-def get_socket_set():
+def make_selector(backend="default"):
     """
-        Return the socket set
+        Return a new selector for the named backend.
+        example: "epoll", "poll", or "select"
     """
-    return socketSet
+    selectorClass = SELECTOR_BACKENDS.get(backend)
+    if selectorClass is None:
+        raise ValueError(f"event loop backend not available: {backend}")
+    return selectorClass()
 
-def add_to_socket_set(socket):
+def set_selector(backend="default"):
     """
-        Add a socket to the socket set
+        Replace the selector the sockets get registered with.
     """
-    socketSet = get_socket_set()
-    socketSet.add(socket)
-    
-def remove_from_socket_set(socket):
+    global selector
+    selector = make_selector(backend)
+
+def get_selector():
     """
-        Remove a socket from the socket set
+        Return the selector, creating the default one if needed.
     """
-    socketSet = get_socket_set()
-    socketSet.remove(socket)
-    pass
+    if selector is None:
+        set_selector()
+    return selector
 
-def recv_buffer():
+def add_connection(socket):
     """
-        Return all buffers that holds the recieved data from clients
+        Start keeping track of a new client and watch it for reads.
+        Returns its Connection.
     """
-    return recvBuffer
+    connection = Connection(socket)
+    connections[connection.fd] = connection
+    update_interest(connection)
+    return connection
 
-def get_buffer_from_recv_buffer(socket):
+def remove_connection(connection):
     """
-        Return a specific buffer in the buffers array.
+        Forget a client and stop watching its socket. The socket itself is
+        left open.
     """
-    buffer = recv_buffer()
-    return buffer[socket]
-    
-def add_connection_to_recv_buffer(connection):
+    connections.pop(connection.fd, None)
+    connection.closed = True
+    # A paused client with nothing to send isn't registered
+    if connection.events:
+        get_selector().unregister(connection.socket)
+        connection.events = 0
+
+def add_nick(connection, nick):
+    """
+        Give a client a nick nobody else is using.
     """
-        Add a new buffer for a connection.
+    connection.nick = nick
+    nickIndex[nick] = connection
+
+def release_nick(connection):
+    """
+        Free a client's nick for somebody else. Its token bucket stays until
+        it is full again, see sweep_nick_buckets().
     """
-    recvBuffer = recv_buffer()
-    recvBuffer[connection] = b''
+    del nickIndex[connection.nick]
+    connection.nick = None
 
-def remove_from_recv_buffer(socket):
+def get_nick_connection(nick):
     """
-        Remove a buffer from the buffer array.
+        Return the client using a nick, or None.
     """
-    recvBuffer = recv_buffer()
-    recvBuffer.pop(socket)
+    return nickIndex.get(nick)
 
-def client_alias():
+def set_encoding(connection, encoding):
     """
-        Return the array of client aliases (nicknames)
+        Remember the payload encoding a client asked for. Anything we don't
+        know means JSON, which every client understands.
     """
-    return clientAlias
+    connection.encoding = encoding if encoding in chat_protocol.ENCODINGS else "json"
 
-def add_alias(socket, alias):
+def set_compression(connection, compression):
     """
-        Add an alias to the alias array
+        Remember the compression a client asked for, and give deflate-stream
+        clients their own compression context. Anything we don't know means
+        no compression.
     """
-    allAliases = client_alias()
-    allAliases[socket] = alias
+    connection.compressor = None
+    if compression in chat_protocol.COMPRESSIONS:
+        connection.compression = compression
+        if compression == "deflate-stream":
+            connection.compressor = chat_protocol.make_compressor()
+    else:
+        connection.compression = None
 
-def get_alias(socket):
+def get_compression_stats():
     """
-        Return a specific client from the alias array.
+        Return the compression counters along with the share of bytes saved.
     """
-    allAliases = client_alias()
-    return allAliases[socket]
+    stats = {"raw_bytes": chat_metrics.get_counter("chat_compress_raw_bytes_total"),
+             "wire_bytes": chat_metrics.get_counter("chat_compress_wire_bytes_total")}
+    stats["saved_ratio"] = 1 - stats["wire_bytes"] / max(stats["raw_bytes"], 1)
+    return stats
 
-def remove_from_client_alias(socket):
+def get_channel_members(channel):
     """
-        Remove an alias from the alias array.
+        Return the set of clients in a channel, empty if nobody is in it.
     """
-    clientAlias = client_alias()
-    clientAlias.pop(socket)
+    return channelMembers.get(channel, ())
 
-def expected_packet_length():
+def add_to_channel(connection, channel):
     """
-        Return the amount of bytes a packets length section is.
+        Put a client in a channel. Returns False if it already was.
+    """
+    members = channelMembers.setdefault(channel, set())
+    if connection in members:
+        return False
+    members.add(connection)
+    connection.channels.add(channel)
+    return True
+
+def remove_from_channel(connection, channel):
+    """
+        Take a client out of a channel. Returns False if it wasn't in it.
+    """
+    members = channelMembers.get(channel)
+    if members is None or connection not in members:
+        return False
+    members.remove(connection)
+    if not members:
+        del channelMembers[channel]
+    connection.channels.discard(channel)
+    return True
+
+def remove_from_all_channels(connection):
     """
-    return PACKET_LEN_SIZE
+        Take a client out of every channel it is in.
+    """
+    channels, connection.channels = connection.channels, set()
+    for channel in channels:
+        members = channelMembers[channel]
+        members.remove(connection)
+        if not members:
+            del channelMembers[channel]
+
 # --- End of functions to Get / Add / Remove from  variables ---
 
 
@@ -173,48 +951,34 @@ def expected_packet_length():
 
 def get_data(socket):
     """
-        Return the data that the client socket is sending.
+        Return the data that the client socket is sending, as a view into
+        the shared receive scratch buffer. It is only valid until the next
+        get_data() call.
     """
-    return socket.recv(4096)
+    count = socket.recv_into(recvScratch)
+    if count == 0:
+        raise ConnectionResetError("client closed the connection")
+    return recvView[:count]
 
 
-def process_recv(newData, buffer):
-    """
-        Takes new data and adds it to the buffer. If the buffer has a full packet,
-        it will return that complete packet as a Python native datatype.
+def process_recv(newData, decoder):
     """
-    
-    # Add data to the current buffer
-    buffer += newData
-    
-    expectedLength = expected_packet_length()
-    
-    # Check to see if buffer has at least the packet length
-    if len(buffer) >= expectedLength:
-        packetLength = int.from_bytes(buffer[:expectedLength], "big")
+        Takes new data and feeds it to a connection's FrameDecoder. Returns
+        every full packet received so far as a list of Python native
+        datatypes, the decoder keeps any partial packet for next time.
 
-        # Check if the buffer has a full payload packet
-        if len(buffer) >= (packetLength + expectedLength):
-            # Extract and Decode Payload
-            decodedPayload = extract_payload(buffer, expectedLength, packetLength)
-            return decodedPayload
+        Stops after a hello packet, which can switch the framing of the
+        packets after it. Raises ValueError for a packet longer than the
+        decoder's maxFrame, or one that can't be decoded.
+    """
+    return decoder.decode(newData, chat_protocol.decode_payload, is_hello)
 
 
-def extract_payload(buffer, expectedLength, packetLength):
+def is_hello(payload):
     """
-        Returns a python native data type from the byte payload in the buffer. 
+        Returns True for a hello payload.
     """
-    # Get payload after length bytes
-    payloadBytes = buffer[expectedLength:]
-    # Decode those bytes into Python native data
-    payloadDecoded = payloadBytes.decode("ISO-8859-1")
-    payloadDecoded = json.loads(payloadDecoded)
-
-
-    # Remove the packet from buffer
-    buffer = buffer[(expectedLength + packetLength):]
-
-    return payloadDecoded
+    return get_payload_type(payload) == "hello"
 # ---- End of Functions to process Recv Packet -------------
 
 
@@ -225,96 +989,1115 @@ def get_payload_type(payload):
         Returns what the payloads type is.
         example: "chat", "join", or "leave" 
     """
+    if not isinstance(payload, dict):
+        return None
     return payload.get("type")
 
 
-def transmit_disconnect(leavingSocket, listenSocket):
+def transmit_disconnect(leaving, listenSocket, channels):
     """
-        Create a message to be sent to all connected clients when a
-        client disconnects.
+        Create a message to be sent to the clients in the given channels
+        when a client disconnects.
     """
+    # Nothing to announce for a client that never said hello, or when
+    # everyone is leaving
+    if leaving.nick is None or shutdownDeadline is not None:
+        return
+
     # Create the leave message
-    alias = get_alias(leavingSocket)
-    message = {"type": "leave", "nick": alias}
+    message = {"type": "leave", "nick": leaving.nick}
     
-    # Send message off to be transmitted
-    transmit_to_clients(listenSocket, message)
+    # Send message off to everyone sharing a channel with the client
+    transmit_to_clients(listenSocket, message, channels)
             
             
-def transmit_connected(connectingSocket, listenSocket):
+def get_hello_channels(hello):
     """
-        Create a message to be sent to all connected clients when a
-        client connects.
+        Return the channels a client joins when it says hello: the default
+        one and every valid one in the hello's "channels" list.
     """
-    # Get the socket set
-    socketSet = get_socket_set()
-    
+    channels = [DEFAULT_CHANNEL]
+    requested = hello.get("channels")
+    if isinstance(requested, list):
+        for channel in requested:
+            channel = get_channel_name({"channel": channel})
+            if channel is not None and channel not in channels:
+                channels.append(channel)
+    return channels
+
+
+def is_resuming(holder, hello):
+    """
+        Return True if a hello carries the resume token the client holding
+        its nick was welcomed with, as from that client reconnecting.
+    """
+    token = hello.get("token")
+    if not isinstance(token, str) or holder.resumeToken is None:
+        return False
+    return hmac.compare_digest(token.encode(), holder.resumeToken.encode())
+
+
+def welcome_client(connection, hello, channels, framing):
+    """
+        Answer a hello with a welcome payload holding the server's epoch,
+        newest sequence number and the client's resume token. The welcome
+        still goes out in the framing the client had, everything after it
+        in the framing the hello asked for, so a client that can't read the
+        new one yet can read a refusal. A hello with "last_seq" and "epoch"
+        from this server run then gets every broadcast to the given
+        channels it missed, and the welcome says whether that covers the
+        whole gap.
+    """
+    if connection.resumeToken is None:
+        connection.resumeToken = secrets.token_hex(16)
+    welcome = {"type": "welcome", "epoch": serverEpoch, "seq": broadcastSeq,
+               "token": connection.resumeToken}
+    lastSeq = hello.get("last_seq")
+    resumed = (hello.get("epoch") == serverEpoch and type(lastSeq) is int
+               and can_replay(lastSeq))
+    if "last_seq" in hello:
+        welcome["resumed"] = resumed
+
+    send_to_client(connection, welcome)
+    connection.framing = framing
+    if resumed:
+        replay_since(connection, lastSeq, channels)
+
+
+def can_replay(lastSeq):
+    """
+        Return True if every broadcast after sequence number lastSeq is
+        still in the replay buffer.
+    """
+    if lastSeq == broadcastSeq:
+        return True
+    return bool(replayBuffer) and replayBuffer[0][0] - 1 <= lastSeq < broadcastSeq
+
+
+def replay_since(connection, lastSeq, channels):
+    """
+        Queue every broadcast to the given channels after sequence number
+        lastSeq as one packet. can_replay(lastSeq) has to be True.
+    """
+    if lastSeq == broadcastSeq:
+        return
+
+    # The buffer has no gaps, so the first one to send is found by position
+    wanted = set(channels)
+    packets = []
+    for seq, messageChannels, message in islice(replayBuffer, lastSeq + 1 - replayBuffer[0][0], None):
+        if messageChannels is None or not wanted.isdisjoint(messageChannels):
+            packets.append(packet_for_client(connection, message, {}))
+
+    if packets:
+        queue_packet(connection, b"".join(packets))
+
+
+def get_channel_name(payload):
+    """
+        Return the channel a join or part payload names, or None if it
+        doesn't name a valid one.
+    """
+    channel = payload.get("channel")
+    if not isinstance(channel, str) or not 0 < len(channel) <= MAX_CHANNEL_NAME:
+        return None
+    return channel
+
+
+def join_channel(connection, channel, listenSocket):
+    """
+        Put a client in a channel and tell the channel's members, the new
+        one included.
+    """
+    if not add_to_channel(connection, channel):
+        return
+
     # Create the connecting message
-    alias = get_alias(connectingSocket)
-    message = {"type": "join", "nick": alias}
+    message = {"type": "join", "nick": connection.nick, "channel": channel}
     
     # Send message off to be transmitted
-    transmit_to_clients(listenSocket, message)
+    transmit_to_clients(listenSocket, message, (channel,))
 
 
-def transmit_message(TransmittingSocket, listenSocket, payload):
+def part_channel(leaving, channel, listenSocket):
     """
-        Create a message to be sent to all connected clients when a
-        client sends a chat message to the chat room.
+        Take a client out of a channel and tell the channel's members, the
+        leaving one included. Nothing happens if it isn't in the channel.
     """
+    if channel not in leaving.channels:
+        return
+
+    message = {"type": "part", "nick": leaving.nick, "channel": channel}
+
+    # Tell the members before the client is gone from the member set
+    transmit_to_clients(listenSocket, message, (channel,))
+    remove_from_channel(leaving, channel)
+
+
+def transmit_message(transmitting, listenSocket, payload):
+    """
+        Create a message to be sent to the members of a channel when a
+        client sends a chat message to it. Clients can only talk in
+        channels they are in.
+    """
+    channel = get_channel_name(payload) if "channel" in payload else DEFAULT_CHANNEL
+    if channel is None or channel not in transmitting.channels:
+        return
 
     # Create the chat message
-    alias = get_alias(TransmittingSocket)
     payloadMessage = payload.get("message")
-    message = {"type": "chat", "nick": alias, "message": payloadMessage}
+    message = {"type": "chat", "nick": transmitting.nick, "message": payloadMessage}
+    if channel != DEFAULT_CHANNEL:
+        message["channel"] = channel
+
+    # Keep it for the clients that ask for history later
+    chat_log.log_message(message, channel)
     
     # Send message off to be transmitted
-    transmit_to_clients(listenSocket, message)
+    transmit_to_clients(listenSocket, message, (channel,))
+
+
+def send_private_message(sending, payload):
+    """
+        Send a private message to the client using the nick it names, and
+        a copy back to the sender. It is found by nick in one lookup and
+        gets no sequence number, so it is never replayed or logged. With
+        several workers a nick nobody has here is passed to the others.
+    """
+    target = payload.get("nick")
+    text = payload.get("message")
+    if not isinstance(target, str) or not isinstance(text, str):
+        return
+
+    message = {"type": "privmsg", "nick": sending.nick, "to": target, "message": text}
+    recipient = get_nick_connection(target)
+    if recipient is None and not busPeers:
+        send_to_client(sending, {"type": "error", "code": "no_such_nick", "nick": target,
+                                 "message": f"nobody is using the nick {target}"})
+        return
+
+    if recipient is None:
+        publish_private_to_bus(message, target)
+    elif recipient is not sending:
+        send_to_client(recipient, message)
+    send_to_client(sending, message)
+
+
+def send_history(requesting, payload):
+    """
+        Replay the newest messages of a channel the client is in, oldest
+        first, and end with a history payload saying how many there were.
+        The replay is queued as a single packet so it goes out in one
+        write.
+    """
+    channel = get_channel_name(payload) if "channel" in payload else DEFAULT_CHANNEL
+    if channel is None or channel not in requesting.channels:
+        return
+
+    count = payload.get("count", HISTORY_COUNT)
+    if type(count) is not int:
+        return
+    count = min(count, MAX_HISTORY_COUNT)
+    since = payload.get("since")
+    if since is not None and type(since) not in (int, float):
+        return
+
+    records = chat_log.read_history(channel, count, since)
+    packets = []
+    for record in records:
+        message = record["message"]
+        message["time"] = record["time"]
+        # Sequence numbers are only for live broadcasts
+        message.pop("seq", None)
+        packets.append(packet_for_client(requesting, message, {}))
+    packets.append(packet_for_client(requesting,
+        {"type": "history", "channel": channel, "count": len(records)}, {}))
+
+    queue_packet(requesting, b"".join(packets))
+    dirtyConnections.add(requesting)
 
 
-def transmit_to_clients(listenSocket, message):
+def transmit_to_clients(listenSocket, message, channels=None, fromBus=False):
     """
-        Takes a message and transmits to all connected clients.
+        Takes a message and transmits to the members of the given channels,
+        or to all connected clients if channels is None. The clients of the
+        other workers get it too, unless it came from one of them.
+
+        Every broadcast gets the next sequence number in its "seq" field and
+        goes in the replay buffer, whether anyone gets it now or not.
     """
-    # Get the socket set
-    socketSet = get_socket_set()
+    global broadcastSeq
+
+    fanOutStart = time.perf_counter()
+    chat_metrics.inc("chat_broadcasts_total")
+    broadcastSeq += 1
+    message["seq"] = broadcastSeq
+    if channels is not None:
+        channels = tuple(channels)
+    replayBuffer.append((broadcastSeq, channels, message))
+
+    if busPeers and not fromBus:
+        publish_to_bus(message, channels)
+
+    # Only the channel members, each of them once
+    if channels is None:
+        recipients = connections.values()
+    elif len(channels) == 1:
+        recipients = get_channel_members(next(iter(channels)))
+    else:
+        recipients = set()
+        for channel in channels:
+            recipients.update(get_channel_members(channel))
+
+    if not recipients:
+        return
     
-    # Message Into Json File and Encode
-    jsonMessage = jsonMessage = json.dumps(message)
-    encodedMessage = jsonMessage.encode()
-    # Get Size of Message and Encode
-    messageSize = len(encodedMessage)
-    encodedMessageSize = messageSize.to_bytes(PACKET_LEN_SIZE , byteorder='big')
-    # Combine
-    fullPacket = encodedMessageSize + encodedMessage
+    # Encode once per wire format, every client using the same one gets
+    # the same packet object
+    packets = {}
     
-    # Send Packet
-    for socket in socketSet:
-        if socket is not listenSocket:
-            try: 
-                socket.sendall(fullPacket)
-            except:
-                # Socket already Disconnected
-                continue
+    # Queue the packet for everyone. It is sent at the end of the round,
+    # together with anything else broadcast in the same round.
+    delivered = 0
+    for connection in recipients:
+        if connection not in pendingDisconnects:
+            fullPacket = packet_for_client(connection, message, packets)
+            if fullPacket:
+                queue_packet(connection, fullPacket)
+                dirtyConnections.add(connection)
+                delivered += 1
+
+    chat_metrics.inc("chat_broadcast_deliveries_total", delivered)
+    chat_metrics.observe("chat_broadcast_seconds", time.perf_counter() - fanOutStart)
+
+
+def send_to_client(connection, message):
+    """
+        Queue a message for one client only.
+    """
+    fullPacket = packet_for_client(connection, message, {})
+    if fullPacket:
+        queue_packet(connection, fullPacket)
+        dirtyConnections.add(connection)
+
+
+def packet_for_client(connection, message, packets):
+    """
+        Return a message as a packet in a client's encoding, framing and
+        compression, or b"" if it is too big for the client's framing.
+        packets caches what clients with the same wire format can share:
+        whole packets, and payloads for deflate-stream clients, which need
+        their own compression.
+    """
+    encoding = connection.encoding
+    framing = connection.framing
+    compression = connection.compression
+
+    if compression is None:
+        wireFormat = (encoding, framing)
+        fullPacket = packets.get(wireFormat)
+        if fullPacket is None:
+            try:
+                fullPacket = frame_payload(get_payload(message, encoding, packets), framing)
+            except OverflowError:
+                # Too big for this client's framing, it can't get it
+                fullPacket = b""
+            packets[wireFormat] = fullPacket
+        return fullPacket
+
+    payload = get_payload(message, encoding, packets)
+    if len(payload) >= chat_protocol.FRAMING_LIMITS[framing]:
+        # Too big for this client's framing even before compressing
+        return b""
+
+    if compression == "deflate-stream":
+        # The client's own context, so compressed again for every client
+        wirePayload = chat_protocol.compress_payload(payload, connection.compressor)
+    else:
+        # Compressed once for every client with the same wire format
+        wireFormat = (encoding, compression)
+        wirePayload = packets.get(wireFormat)
+        if wirePayload is None:
+            wirePayload = packets[wireFormat] = chat_protocol.compress_payload(payload)
+
+    chat_metrics.inc("chat_compress_raw_bytes_total", len(payload))
+    chat_metrics.inc("chat_compress_wire_bytes_total", len(wirePayload))
+
+    try:
+        return frame_payload(wirePayload, framing)
+    except OverflowError:
+        # Compression made it grow past the limit. A deflate-stream client
+        # can't skip a payload its context has seen, so it has to go.
+        if compression == "deflate-stream":
+            schedule_disconnect(connection)
+        return b""
+
+
+def get_payload(message, encoding, packets):
+    """
+        Return a message encoded as a payload, encoding it only once per
+        broadcast.
+    """
+    payload = packets.get(encoding)
+    if payload is None:
+        payload = packets[encoding] = chat_protocol.encode_payload(message, encoding)
+    return payload
+
+
+def frame_payload(payload, framing="u16"):
+    """
+        Return a payload with its length prefix in front. Raises
+        OverflowError if the payload is too big for the framing.
+    """
+    return chat_protocol.encode_length(len(payload), framing) + payload
+
+
+def encode_packet(message, framing="u16", encoding="json"):
+    """
+        Return a message as a packet: the payload length followed by the
+        payload, UTF-8 JSON unless another encoding is asked for. Raises
+        OverflowError if the payload is too big for the framing.
+    """
+    # Message Into Json or Binary and Encode
+    encodedMessage = chat_protocol.encode_payload(message, encoding)
+    # Get Size of Message and Encode, then Combine
+    return frame_payload(encodedMessage, framing)
 
 # ---- End of Functions to process Payload -----
+
+
+
+# ---- Functions to send queued Packets -----
+def queue_packet(connection, packet):
+    """
+        Add a packet to a client's send queue, applying the slow client policy
+        if the queue grows past the high-water mark.
+    """
+    connection.sendQueue.append(packet)
+    connection.sendQueueBytes += len(packet)
+
+    # Workers never drop each other's broadcasts
+    if connection.sendQueueBytes > SEND_HIGH_WATER and not connection.isBus:
+        handle_slow_client(connection)
+
+
+def handle_slow_client(connection):
+    """
+        Bring a client's send queue back under the high-water mark. A packet
+        that is partly sent always stays, or the stream would be corrupted.
+    """
+    chat_metrics.inc("chat_slow_client_events_total")
+    if SLOW_CLIENT_POLICY == "disconnect":
+        schedule_disconnect(connection)
+        return
+
+    queue = connection.sendQueue
+    # Packets from this index on may be thrown away
+    firstDroppable = 1 if connection.sendOffset else 0
+
+    if connection.compression == "deflate-stream" and len(queue) > firstDroppable + 1:
+        # Its context has seen every queued packet, so the client can't
+        # decompress the rest if any of them go
+        schedule_disconnect(connection)
+        return
+
+    if SLOW_CLIENT_POLICY == "coalesce":
+        # Keep only the newest packet, the client skips to the latest state
+        while len(queue) > firstDroppable + 1:
+            dropped = queue[firstDroppable]
+            del queue[firstDroppable]
+            connection.sendQueueBytes -= len(dropped)
+    else:
+        # drop-oldest
+        while connection.sendQueueBytes > SEND_HIGH_WATER and len(queue) > firstDroppable + 1:
+            dropped = queue[firstDroppable]
+            del queue[firstDroppable]
+            connection.sendQueueBytes -= len(dropped)
+
+
+def flush_dirty_connections():
+    """
+        Send to every client that had packets queued this round.
+    """
+    while dirtyConnections:
+        flush_send_queue(dirtyConnections.pop())
+
+
+def flush_send_queue(connection):
+    """
+        Send as much of a client's queue as it will take without blocking,
+        and only watch for write readiness while something is left.
+    """
+    queue = connection.sendQueue
+
+    try:
+        if connection.tls:
+            # No sendmsg() on SSL sockets
+            send_tls(connection)
+            queue = ()
+        while queue:
+            sent, frames = send_batch(connection.socket, queue, connection.sendOffset)
+            chat_metrics.inc("chat_send_calls_total")
+            chat_metrics.inc("chat_frames_sent_total", frames)
+            chat_metrics.inc("chat_bytes_sent_total", sent)
+            connection.sendQueueBytes -= sent
+
+            # Pop the packets that went out completely
+            sent += connection.sendOffset
+            while queue and sent >= len(queue[0]):
+                sent -= len(queue.popleft())
+            connection.sendOffset = sent
+
+            if sent:
+                # Client can't take any more right now
+                break
+    except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+        pass
+    except OSError:
+        # Socket already Disconnected
+        if connection.isBus:
+            remove_bus_peer(connection)
+        else:
+            schedule_disconnect(connection)
+        return
+
+    update_interest(connection)
+
+
+def send_batch(socket, queue, offset):
+    """
+        Send the front of a queue in one system call, skipping the first
+        offset bytes that already went out. Returns the bytes sent and how
+        many packets were handed to the call.
+    """
+    if not hasattr(socket, "sendmsg"):
+        # No vectored sends on this platform, one packet per call
+        return socket.send(memoryview(queue[0])[offset:]), 1
+
+    buffers = []
+    for packet in queue:
+        buffers.append(packet)
+        if len(buffers) == SEND_BATCH_SIZE:
+            break
+    if offset:
+        buffers[0] = memoryview(buffers[0])[offset:]
+
+    return socket.sendmsg(buffers), len(buffers)
+
+
+def send_tls(connection):
+    """
+        Send as much of a TLS client's queue as it will take. The packets
+        are joined into chunks of up to TLS_SEND_SIZE bytes, one send() and
+        one TLS record each. A send() that has to wait must be retried with
+        the same bytes, so a chunk is taken out of the queue, where the slow
+        client policy can't touch it, until it has all gone out.
+    """
+    queue = connection.sendQueue
+    while connection.tlsChunk or queue:
+        if not connection.tlsChunk:
+            packets = [queue.popleft()]
+            size = len(packets[0])
+            while queue and size + len(queue[0]) <= TLS_SEND_SIZE:
+                size += len(queue[0])
+                packets.append(queue.popleft())
+            connection.tlsChunk = b"".join(packets) if len(packets) > 1 else packets[0]
+            chat_metrics.inc("chat_frames_sent_total", len(packets))
+
+        sent = connection.socket.send(connection.tlsChunk)
+        chat_metrics.inc("chat_send_calls_total")
+        chat_metrics.inc("chat_bytes_sent_total", sent)
+        connection.sendQueueBytes -= sent
+        connection.tlsChunk = connection.tlsChunk[sent:]
+
+
+def get_send_stats():
+    """
+        Return the send counters along with the average packets per call.
+    """
+    stats = {"syscalls": chat_metrics.get_counter("chat_send_calls_total"),
+             "frames": chat_metrics.get_counter("chat_frames_sent_total"),
+             "bytes": chat_metrics.get_counter("chat_bytes_sent_total")}
+    stats["frames_per_syscall"] = stats["frames"] / max(stats["syscalls"], 1)
+    return stats
+
+
+def update_interest(connection):
+    """
+        Watch a client for write readiness only while its queue has packets,
+        and for read readiness unless its reads are paused. A client with
+        neither is taken out of the selector. During a TLS handshake only
+        the event the handshake waits for is watched.
+    """
+    events = 0 if connection.paused else selectors.EVENT_READ
+    if connection.sendQueue or connection.tlsChunk:
+        events |= selectors.EVENT_WRITE
+    if connection.handshake:
+        events = connection.handshake
+
+    current = connection.events
+    if current == events:
+        return
+    selector = get_selector()
+    if not events:
+        selector.unregister(connection.socket)
+    elif not current:
+        selector.register(connection.socket, events, connection)
+    else:
+        selector.modify(connection.socket, events, connection)
+    connection.events = events
+
+# ---- End of Functions to send queued Packets -----
+
+
+
+# ---- Functions for TLS -----
+def make_tls_context(certFile, keyFile):
+    """
+        Return a server SSLContext with the given certificate chain and
+        private key, both PEM files. Clients can resume their session with
+        a TLS 1.3 ticket, or a session ID with TLS 1.2, and skip most of
+        the handshake when they reconnect. Made once before the workers are
+        started, so every worker takes the tickets of the others.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certFile, keyFile)
+    # One ticket per full handshake is enough for a client that reconnects
+    # one connection at a time
+    context.num_tickets = 1
+    return context
+
+
+def continue_handshake(connection, listenSocket):
+    """
+        Take a TLS client's handshake as far as it goes without blocking.
+        Once it is done the client is read from like any other, starting
+        with whatever came in along with the end of the handshake.
+    """
+    try:
+        connection.socket.do_handshake()
+    except ssl.SSLWantReadError:
+        connection.handshake = selectors.EVENT_READ
+    except ssl.SSLWantWriteError:
+        connection.handshake = selectors.EVENT_WRITE
+    except OSError:
+        # Not a TLS client, or a broken one
+        chat_metrics.inc("chat_tls_handshake_failures_total")
+        schedule_disconnect(connection)
+        return
+    else:
+        connection.handshake = 0
+        chat_metrics.inc("chat_tls_handshakes_total",
+                         label="resumed" if connection.socket.session_reused else "full")
+        chat_metrics.observe("chat_tls_handshake_seconds", loopTime - connection.connectedAt)
+
+    update_interest(connection)
+    if not connection.handshake:
+        receive_packets(connection, listenSocket)
+
+# ---- End of Functions for TLS -----
+
+
+
+# ---- Functions for shutdown and hot restart -----
+def install_signal_handlers():
+    """
+        Have SIGTERM and SIGINT start a graceful shutdown. The handler only
+        sets a flag, the socket set_wakeup_fd() writes to wakes up select()
+        so the loop gets to it.
+    """
+    global wakeupSocket, wakeupWriter
+
+    def request_stop(signum, frame):
+        global stopRequested
+        stopRequested = True
+
+    wakeupSocket, wakeupWriter = socket.socketpair()
+    wakeupSocket.setblocking(False)
+    wakeupWriter.setblocking(False)
+    signal.set_wakeup_fd(wakeupWriter.fileno())
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    get_selector().register(wakeupSocket, selectors.EVENT_READ)
+
+
+def drain_wakeups():
+    """
+        Throw away the signal numbers written to the wakeup socket.
+    """
+    try:
+        while wakeupSocket.recv(RECV_SIZE):
+            pass
+    except BlockingIOError:
+        pass
+
+
+def begin_shutdown(listenSocket):
+    """
+        Stop accepting clients and tell every client to reconnect after a
+        random delay. From here on nothing they send is acted on, and they
+        are closed once their queue is sent or DRAIN_TIMEOUT has passed.
+    """
+    global shutdownDeadline
+
+    shutdownDeadline = time.monotonic() + DRAIN_TIMEOUT
+    if listenSocket.fileno() != -1:
+        get_selector().unregister(listenSocket)
+        listenSocket.close()
+    close_control()
+    deadlineHeap.clear()
+
+    for connection in connections.values():
+        if connection.nick is not None and connection not in pendingDisconnects:
+            send_to_client(connection, {"type": "shutdown",
+                "retry_after": round(random.uniform(0, RECONNECT_SPREAD), 2)})
+    flush_round(listenSocket)
+
+
+def drain_clients(listenSocket):
+    """
+        Close every client whose queue has gone out, or all of them once
+        DRAIN_TIMEOUT has passed. Returns True when none are left.
+    """
+    timedOut = time.monotonic() >= shutdownDeadline
+    for connection in connections.values():
+        if timedOut or not (connection.sendQueue or connection.tlsChunk):
+            schedule_disconnect(connection)
+    flush_round(listenSocket)
+    return not connections
+
+
+def end_shutdown():
+    """
+        Close what is left once every client is gone.
+    """
+    global statsSocket
+
+    for peer in list(busPeers.values()):
+        remove_bus_peer(peer)
+    if statsSocket is not None:
+        get_selector().unregister(statsSocket)
+        statsSocket.close()
+        statsSocket = None
+    for statsClient in list(statsClients):
+        close_stats_client(statsClient)
+    chat_log.close_log()
+
+
+def listen_control(path):
+    """
+        Listen on a Unix socket for a new server process that wants to
+        take over.
+    """
+    global controlSocket, controlPath
+
+    controlSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    controlSocket.bind(path)
+    controlSocket.listen()
+    controlSocket.setblocking(False)
+    controlPath = path
+    get_selector().register(controlSocket, selectors.EVENT_READ)
+
+
+def close_control():
+    """
+        Stop listening on the control socket, so the next server can.
+    """
+    global controlSocket, controlPath
+
+    if controlSocket is None:
+        return
+    get_selector().unregister(controlSocket)
+    controlSocket.close()
+    os.unlink(controlPath)
+    controlSocket = None
+    controlPath = None
+
+
+def take_over(path):
+    """
+        Take the listening socket and the broadcast sequence state from the
+        server listening on the control socket at path, if there is one.
+        The socket comes over the control socket with SCM_RIGHTS, so it
+        never stops accepting and no connection is refused. Keeping the
+        epoch, sequence number and replay buffer lets clients resume across
+        the restart. Returns the listening socket, or None if no server is
+        running there.
+    """
+    global serverEpoch, broadcastSeq
+
+    oldServer = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    oldServer.settimeout(HANDOVER_TIMEOUT)
+    try:
+        oldServer.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        # Left behind by a server that didn't stop cleanly
+        if os.path.exists(path):
+            os.unlink(path)
+        oldServer.close()
+        return None
+
+    with oldServer:
+        oldServer.sendall(b"takeover")
+        _, fds, _, _ = socket.recv_fds(oldServer, 1, 1)
+        if not fds:
+            raise OSError(f"no listening socket from the server at {path}")
+        # The state follows, and the end of it means the old server has
+        # closed its log and its control socket
+        data = bytearray()
+        while True:
+            chunk = oldServer.recv(RECV_SIZE)
+            if not chunk:
+                break
+            data += chunk
+
+    listenSocket = socket.socket(fileno=fds[0])
+    listenSocket.setblocking(False)
+    state = chat_protocol.FrameDecoder("u32").decode(data)[0]
+    serverEpoch = state["epoch"]
+    broadcastSeq = state["seq"]
+    replayBuffer.clear()
+    for seq, channels, message in state["replay"]:
+        replayBuffer.append((seq, None if channels is None else tuple(channels), message))
+    return listenSocket
+
+
+def hand_over(listenSocket):
+    """
+        Give the listening socket and the broadcast sequence state to a new
+        server process on the control socket, then shut down at the end of
+        the round. If the hand over fails this server just goes on.
+    """
+    global stopRequested
+
+    try:
+        newServer, _ = controlSocket.accept()
+    except (BlockingIOError, InterruptedError):
+        return
+
+    with newServer:
+        newServer.settimeout(HANDOVER_TIMEOUT)
+        try:
+            if newServer.recv(RECV_SIZE) != b"takeover":
+                return
+            state = {"epoch": serverEpoch, "seq": broadcastSeq,
+                     "replay": [[seq, channels, message] for seq, channels, message in replayBuffer]}
+            socket.send_fds(newServer, [b"L"], [listenSocket.fileno()])
+            newServer.sendall(encode_packet(state, "u32"))
+        except OSError:
+            return
+
+        # The new server opens the log and the control socket once this
+        # connection closes
+        chat_log.close_log()
+        close_control()
+
+    stopRequested = True
+
+# ---- End of Functions for shutdown and hot restart -----
+
+
+
+# ---- Functions for the stats endpoint -----
+def listen_stats(port):
+    """
+        Start listening for metrics readers on localhost. Anything that
+        connects and sends a request, like an HTTP GET from curl or
+        Prometheus, gets every metric in the Prometheus text format.
+    """
+    global statsSocket
+
+    statsSocket = socket.socket()
+    statsSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    statsSocket.bind(("127.0.0.1", port))
+    statsSocket.listen()
+    statsSocket.setblocking(False)
+    get_selector().register(statsSocket, selectors.EVENT_READ)
+
+
+def process_stats_event(readySocket):
+    """
+        Accept a metrics reader, answer one that sent its request, or send
+        more of the answer to one that can take it. The answer is sent
+        without blocking like everything else, and a reader gets
+        STATS_TIMEOUT from connecting to be done.
+    """
+    if readySocket is statsSocket:
+        try:
+            newConnection, _ = statsSocket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        newConnection.setblocking(False)
+        statsClients[newConnection] = [loopTime + STATS_TIMEOUT, None]
+        get_selector().register(newConnection, selectors.EVENT_READ)
+        return
+
+    reply = statsClients[readySocket][1]
+    try:
+        if reply is None:
+            if not readySocket.recv(RECV_SIZE):
+                close_stats_client(readySocket)
+                return
+            body = chat_metrics.render().encode()
+            reply = bytearray(b"HTTP/1.0 200 OK\r\n"
+                              b"Content-Type: text/plain; version=0.0.4\r\n"
+                              b"Content-Length: %d\r\n\r\n" % len(body))
+            reply += body
+            statsClients[readySocket][1] = reply
+            get_selector().modify(readySocket, selectors.EVENT_WRITE)
+        del reply[:readySocket.send(reply)]
+    except (BlockingIOError, InterruptedError):
+        return
+    except OSError:
+        reply = None
+    if not reply:
+        close_stats_client(readySocket)
+
+
+def drop_late_stats_clients():
+    """
+        Close the metrics readers that are past their deadline, whether
+        they never sent a request or didn't take the answer.
+    """
+    for statsClient, (deadline, _) in list(statsClients.items()):
+        if deadline <= loopTime:
+            close_stats_client(statsClient)
+
+
+def close_stats_client(statsClient):
+    """
+        Forget a metrics reader and hang up on it.
+    """
+    del statsClients[statsClient]
+    get_selector().unregister(statsClient)
+    statsClient.close()
+
+# ---- End of Functions for the stats endpoint -----
+
+
+
+# ---- Functions for multiple worker processes -----
+def run_workers(port, workerCount, *serverArgs, logDir=None, statsPort=None,
+                **serverOptions):
+    """
+        Runs the Chat Server in workerCount processes that all listen on the
+        same port with SO_REUSEPORT. Every pair of workers is joined by a
+        Unix domain socket, so a broadcast on one worker reaches the clients
+        of all of them. Returns once every worker has exited.
+
+        Every worker keeps its own message log in a subdirectory of logDir,
+        holding the chat messages of all the workers. Worker i serves its
+        metrics on statsPort + i.
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise OSError("SO_REUSEPORT is not supported on this platform")
+
+    # Connect every worker to every other worker
+    busSockets = [[] for _ in range(workerCount)]
+    for i in range(workerCount):
+        for j in range(i + 1, workerCount):
+            a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+            busSockets[i].append(a)
+            busSockets[j].append(b)
+
+    workerPids = []
+    for i in range(workerCount):
+        pid = os.fork()
+        if pid == 0:
+            # Only keep this worker's ends of the bus
+            for j, sockets in enumerate(busSockets):
+                if j != i:
+                    for s in sockets:
+                        s.close()
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            workerLogDir = None
+            if logDir is not None:
+                workerLogDir = os.path.join(logDir, f"worker-{i}")
+            try:
+                run_server(port, *serverArgs, logDir=workerLogDir,
+                           statsPort=None if statsPort is None else statsPort + i,
+                           busSockets=busSockets[i], reusePort=True, **serverOptions)
+            finally:
+                os._exit(0)
+        workerPids.append(pid)
+
+    for sockets in busSockets:
+        for s in sockets:
+            s.close()
+
+    # Stopping the parent stops the workers
+    def stop_workers(signum, frame):
+        for pid in workerPids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGINT, stop_workers)
+    signal.signal(signal.SIGTERM, stop_workers)
+
+    for pid in workerPids:
+        os.waitpid(pid, 0)
+
+
+def add_bus_peer(busSocket):
+    """
+        Start listening for broadcasts from another worker.
+    """
+    busSocket.setblocking(False)
+    peer = Connection(busSocket, isBus=True)
+    busPeers[peer.fd] = peer
+    update_interest(peer)
+
+
+def remove_bus_peer(peer):
+    """
+        Forget a worker that has gone away.
+    """
+    busPeers.pop(peer.fd, None)
+    peer.closed = True
+    dirtyConnections.discard(peer)
+    if peer.events:
+        get_selector().unregister(peer.socket)
+    peer.socket.close()
+
+
+def publish_to_bus(message, channels):
+    """
+        Queue a broadcast for every other worker, along with the channels it
+        goes to. Sent with the rest of this round's packets.
+    """
+    if channels is not None:
+        channels = list(channels)
+    busMessage = {"channels": channels, "message": message}
+    busPacket = encode_packet(busMessage, BUS_FRAMING)
+    for peer in busPeers.values():
+        queue_packet(peer, busPacket)
+        dirtyConnections.add(peer)
+
+
+def publish_private_to_bus(message, nick):
+    """
+        Queue a private message for every other worker, to be delivered by
+        the one with a client using the nick.
+    """
+    busPacket = encode_packet({"to": nick, "message": message}, BUS_FRAMING)
+    for peer in busPeers.values():
+        queue_packet(peer, busPacket)
+        dirtyConnections.add(peer)
+
+
+def process_bus_events(peer, mask, listenSocket):
+    """
+        Send queued broadcasts to another worker, and pass the broadcasts it
+        sent us on to our own clients.
+    """
+    if mask & selectors.EVENT_WRITE:
+        flush_send_queue(peer)
+
+    if mask & selectors.EVENT_READ and not peer.closed:
+        try:
+            data = get_data(peer.socket)
+            messages = peer.decoder.decode(data)
+        except BlockingIOError:
+            return
+        except (OSError, ValueError):
+            remove_bus_peer(peer)
+            return
+
+        for busMessage in messages:
+            if "to" in busMessage:
+                # A private message, for one of our clients or for nobody
+                recipient = get_nick_connection(busMessage["to"])
+                if recipient is not None:
+                    send_to_client(recipient, busMessage["message"])
+                continue
+            message, channels = busMessage["message"], busMessage["channels"]
+            # Log the other workers' chat messages too, so history is the
+            # same whichever worker a client lands on
+            if message.get("type") == "chat" and channels:
+                chat_log.log_message(message, channels[0])
+            transmit_to_clients(listenSocket, message, channels, fromBus=True)
+
+# ---- End of Functions for multiple worker processes -----
     
     
     
     
 # Runs the server
 
-def usage():
-    print("usage: chat_server.py port", file=sys.stderr)
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="chat_server.py")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--backend", default="default",
+        choices=[name for name, cls in SELECTOR_BACKENDS.items() if cls],
+        help="event loop backend")
+    parser.add_argument("--high-water", type=int, default=SEND_HIGH_WATER,
+        help="most bytes queued for one client before it counts as slow")
+    parser.add_argument("--slow-policy", default=SLOW_CLIENT_POLICY,
+        choices=SLOW_CLIENT_POLICIES,
+        help="what to do with a client past the high-water mark")
+    parser.add_argument("--max-frame", type=int, default=MAX_FRAME_SIZE,
+        help="largest payload in bytes a client may send")
+    parser.add_argument("--log-dir",
+        help="directory to keep the message log in, no history without one")
+    parser.add_argument("--log-segments", type=int,
+        help="most log segments of %d MiB to keep, all of them by default"
+             % (chat_log.SEGMENT_SIZE // (1024 * 1024)))
+    parser.add_argument("--stats-port", type=int,
+        help="serve metrics in the Prometheus text format on this port on localhost")
+    parser.add_argument("--ping-interval", type=float, default=PING_INTERVAL,
+        help="seconds a client may be silent before it is pinged")
+    parser.add_argument("--ping-timeout", type=float, default=PING_TIMEOUT,
+        help="seconds a pinged client has to answer before it is dropped")
+    parser.add_argument("--rate-limit", type=float, default=RATE_LIMIT,
+        help="payloads per second a connection may send, 0 for no limit")
+    parser.add_argument("--rate-burst", type=int, default=RATE_BURST,
+        help="payloads a connection may send at once")
+    parser.add_argument("--nick-rate-limit", type=float, default=NICK_RATE_LIMIT,
+        help="payloads per second one nick may send, across its reconnects, 0 for no limit")
+    parser.add_argument("--nick-rate-burst", type=int, default=NICK_RATE_BURST,
+        help="payloads one nick may send at once, reconnecting doesn't refill it")
+    parser.add_argument("--throttle", default=THROTTLE_POLICY, choices=THROTTLE_POLICIES,
+        help="what to do with payloads over the rate limit")
+    parser.add_argument("--tls-cert",
+        help="PEM certificate chain to speak TLS with")
+    parser.add_argument("--tls-key",
+        help="PEM private key, if it isn't in the --tls-cert file")
+    parser.add_argument("--drain-timeout", type=float, default=DRAIN_TIMEOUT,
+        help="seconds queued packets get to go out when stopping")
+    parser.add_argument("--control-socket",
+        help="Unix socket path for hot restarts: a new server started with the "
+             "same path takes over the listening socket from the running one")
+    parser.add_argument("--workers", type=int, default=1,
+        help="worker processes sharing the port with SO_REUSEPORT")
+    return parser.parse_args(argv[1:])
 
 def main(argv):
-    try:
-        port = int(argv[1])
-    except:
-        usage()
-        return 1
+    args = parse_args(argv)
+    tls = None
+    if args.tls_cert:
+        tls = make_tls_context(args.tls_cert, args.tls_key)
     
-    run_server(port)
+    if args.workers > 1:
+        if args.control_socket:
+            sys.exit("--control-socket doesn't work with --workers, start the new "
+                     "workers on the same port instead")
+        run_workers(args.port, args.workers, args.backend, args.high_water,
+                    args.slow_policy, args.max_frame, logDir=args.log_dir,
+                    logSegments=args.log_segments, statsPort=args.stats_port,
+                    pingInterval=args.ping_interval, pingTimeout=args.ping_timeout,
+                    rateLimit=args.rate_limit, rateBurst=args.rate_burst,
+                    nickRateLimit=args.nick_rate_limit, nickRateBurst=args.nick_rate_burst,
+                    throttlePolicy=args.throttle, tls=tls,
+                    drainTimeout=args.drain_timeout)
+    else:
+        run_server(args.port, args.backend, args.high_water, args.slow_policy,
+                   args.max_frame, args.log_dir, args.log_segments, args.stats_port,
+                   args.ping_interval, args.ping_timeout, args.rate_limit,
+                   args.rate_burst, args.nick_rate_limit, args.nick_rate_burst,
+                   args.throttle, tls, args.drain_timeout, args.control_socket)
 
 if __name__ == "__main__":
     sys.exit(main(sys.argv))
@@ -0,0 +1,179 @@
+#--------------------------------------#
+# Example usage:                       #
+# python chat_server_async.py 5732     #
+#--------------------------------------#
+
+# The chat server on asyncio instead of a hand written select loop, using
+# uvloop when it is installed. It only speaks version 1 of the protocol in
+# README.md: 16-bit lengths, JSON payloads to every client, and hello, chat,
+# join and leave with everyone in one room. Binary payloads from a client
+# are read, the other hello options are ignored, and a hello asking for
+# version 2 framing gets the connection closed.
+
+import sys
+import signal
+import asyncio
+import argparse
+
+import chat_protocol
+from chat_server import PACKET_LEN_SIZE, SEND_HIGH_WATER, encode_packet, get_payload_type
+
+
+# Client writers and their aliases. A client is here from the moment it
+# connects, its alias is None until it says hello.
+clientAlias = {}
+# The task serving each connection
+connectionTasks = set()
+
+
+async def run_server(port, highWater=SEND_HIGH_WATER):
+    """
+        Runs the Chat Server until SIGINT or SIGTERM, then closes every
+        connection and returns.
+    """
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, stopping.set)
+        except (NotImplementedError, RuntimeError):
+            # No signal handlers on this platform, Ctrl-C still works
+            pass
+
+    server = await asyncio.start_server(
+        lambda reader, writer: serve_client(reader, writer, highWater),
+        port=port)
+
+    async with server:
+        await stopping.wait()
+
+        # Stop accepting, then end every connection
+        server.close()
+        for task in list(connectionTasks):
+            task.cancel()
+        await asyncio.gather(*connectionTasks, return_exceptions=True)
+        await server.wait_closed()
+
+
+async def serve_client(reader, writer, highWater):
+    """
+        Read packets from one client until it hangs up. Runs as its own task.
+    """
+    task = asyncio.current_task()
+    connectionTasks.add(task)
+    clientAlias[writer] = None
+
+    try:
+        while True:
+            payload = await read_payload(reader)
+            process_payload(writer, payload, highWater)
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+        # Client has disconnected or sent a packet we can't read
+        pass
+    finally:
+        connectionTasks.discard(task)
+        disconnect_client(writer, highWater)
+
+
+async def read_payload(reader):
+    """
+        Return the next payload from a client, JSON or binary, as a Python
+        native datatype.
+    """
+    header = await reader.readexactly(PACKET_LEN_SIZE)
+    packetLength = int.from_bytes(header, "big")
+    payloadBytes = await reader.readexactly(packetLength)
+    return chat_protocol.decode_payload(payloadBytes)
+
+
+def process_payload(writer, payload, highWater):
+    """
+        Act on one payload received from a client. Raises ValueError for a
+        hello this server can't talk to.
+    """
+    payloadType = get_payload_type(payload)
+
+    if payloadType == "hello":
+        alias = payload.get("nick")
+        if not isinstance(alias, str) or chat_protocol.hello_framing(payload) != "u16":
+            # No nick, or a framing only chat_server.py has
+            raise ValueError("hello this server can't answer")
+        clientAlias[writer] = alias
+        transmit_to_clients({"type": "join", "nick": alias}, highWater)
+    elif payloadType == "chat":
+        message = {"type": "chat", "nick": clientAlias[writer],
+                   "message": payload.get("message")}
+        transmit_to_clients(message, highWater)
+    else:
+        # Invalid Payload Type
+        pass
+
+
+def disconnect_client(writer, highWater):
+    """
+        Tell everyone a client left and forget about it.
+    """
+    if writer not in clientAlias:
+        return
+
+    alias = clientAlias.pop(writer)
+    writer.close()
+    if alias is not None:
+        transmit_to_clients({"type": "leave", "nick": alias}, highWater)
+
+
+def transmit_to_clients(message, highWater):
+    """
+        Takes a message and transmits to all connected clients. The packet
+        is encoded once. A client whose transport has more than highWater
+        bytes waiting is disconnected instead of buffering without limit.
+    """
+    fullPacket = encode_packet(message)
+    slowClients = []
+
+    for writer in clientAlias:
+        if writer.is_closing():
+            continue
+        writer.write(fullPacket)
+        if writer.transport.get_write_buffer_size() > highWater:
+            slowClients.append(writer)
+
+    for writer in slowClients:
+        disconnect_client(writer, highWater)
+
+
+def install_uvloop():
+    """
+        Use uvloop as the event loop if it is installed. Returns True if it
+        was.
+    """
+    try:
+        import uvloop
+    except ImportError:
+        return False
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
+# Runs the server
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="chat_server_async.py")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--no-uvloop", action="store_true",
+        help="use the default asyncio event loop even if uvloop is installed")
+    parser.add_argument("--high-water", type=int, default=SEND_HIGH_WATER,
+        help="most bytes waiting for one client before it is dropped")
+    return parser.parse_args(argv[1:])
+
+def main(argv):
+    args = parse_args(argv)
+
+    if not args.no_uvloop:
+        install_uvloop()
+
+    asyncio.run(run_server(args.port, args.high_water))
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
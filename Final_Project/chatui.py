@@ -1,44 +1,213 @@
 import sys
 import os
+import time
+import signal
+import threading
+from itertools import islice
+from collections import deque
+
+# Most screen updates per second, messages arriving faster than this are
+# written together in the next frame
+FRAME_RATE = 30
+# Messages kept for scrolling back, the oldest are dropped past this
+SCROLLBACK_LINES = 5000
+
+# Messages waiting for the next frame
+pendingLines = []
+# When the last frame was written, and the timer for the next one
+lastFrame = 0.0
+frameTimer = None
+# The runner thread prints messages while the main thread reads input
+screenLock = threading.Lock()
+# Terminal size, only looked up again when the window is resized
+terminalLines = None
+terminalColumns = None
+# The last SCROLLBACK_LINES messages, oldest first
+scrollback = deque(maxlen=SCROLLBACK_LINES)
+# How many messages up from the newest the bottom of the window is, 0
+# while following new messages
+scrollOffset = 0
+# What the last search was for, its match is the bottom line
+searchText = ""
 
 def init_windows():
+    if hasattr(signal, "SIGWINCH"):
+        signal.signal(signal.SIGWINCH, lambda signum, frame: refresh_terminal_size())
+    refresh_terminal_size()
     print_now(clear_screen())
 
 def read_command(prompt="> "):
+    show_prompt(prompt)
+
+    s = sys.stdin.readline().strip()
+
+    return s
+
+def show_prompt(prompt="> "):
     lines = get_terminal_lines()
 
     buf = position_cursor(lines - 1)
     buf += clear_line()
     buf += prompt
 
-    print_now(buf)
+    with screenLock:
+        print_now(buf)
 
-    s = sys.stdin.readline().strip()
+def print_message(s):
+    global frameTimer
 
-    return s
+    global scrollOffset
+
+    with screenLock:
+        scrollback.append(s)
+        # Scrolled back, keep the window where it is
+        if scrollOffset:
+            scrollOffset = min(scrollOffset + 1, len(scrollback) - 1)
+            return
+
+        pendingLines.append(s)
+        if frameTimer is not None:
+            return
+
+        wait = lastFrame + 1 / FRAME_RATE - time.monotonic()
+        if wait <= 0:
+            render_pending()
+        else:
+            frameTimer = threading.Timer(wait, render_frame)
+            frameTimer.daemon = True
+            frameTimer.start()
+
+def render_frame():
+    global frameTimer
+
+    with screenLock:
+        frameTimer = None
+        render_pending()
+
+def render_pending():
+    # Every message since the last frame in one write, screenLock held
+    global lastFrame
+
+    if not pendingLines:
+        return
 
-def print_message(s):
     lines = get_terminal_lines()
     line = lines - 3
 
     buf = save_cursor_position()
     buf += set_scrolling_region(line)
     buf += position_cursor(line)
-    buf += '\n' + s
+    buf += '\n' + '\n'.join(pendingLines)
     buf += set_scrolling_region()
     buf += restore_cursor_position()
 
+    pendingLines.clear()
+    lastFrame = time.monotonic()
     print_now(buf)
 
 def end_windows():
-    pass
+    global frameTimer
+
+    with screenLock:
+        if frameTimer is not None:
+            frameTimer.cancel()
+            frameTimer = None
+        render_pending()
+
+def scroll_up():
+    global scrollOffset, searchText
+
+    with screenLock:
+        searchText = ""
+        scrollOffset = min(scrollOffset + page_size(), max(len(scrollback) - 1, 0))
+        render_scrollback()
+
+def scroll_down():
+    global scrollOffset, searchText
+
+    with screenLock:
+        searchText = ""
+        scrollOffset = max(scrollOffset - page_size(), 0)
+        render_scrollback()
+
+def search_scrollback(text=""):
+    # Scroll to the newest message above the last match that has text in
+    # it, any case. Text that extends the last search can still match the
+    # message matched last, an empty text looks for the last one again.
+    global scrollOffset, searchText
+
+    with screenLock:
+        if not text:
+            text = searchText
+            start = scrollOffset + 1
+        elif searchText and text.lower().startswith(searchText.lower()):
+            start = scrollOffset
+        else:
+            start = 0
+        if not text:
+            return False
+
+        wanted = text.lower()
+        for offset, line in enumerate(islice(reversed(scrollback), start, None), start):
+            if wanted in line.lower():
+                scrollOffset = offset
+                searchText = text
+                render_scrollback()
+                return True
+
+        print_now(status_line(f"-- no match for {text} --"))
+        return False
+
+def page_size():
+    return max(get_terminal_lines() - 4, 1)
+
+def render_scrollback():
+    # Redraw the whole message window from the scrollback, screenLock held
+    lines = get_terminal_lines()
+    rows = lines - 3
+    end = len(scrollback) - scrollOffset
+    visible = list(islice(scrollback, max(end - rows, 0), end))
+    # Bottom aligned like the scrolling region
+    visible = [""] * (rows - len(visible)) + visible
+
+    buf = save_cursor_position()
+    for row, s in enumerate(visible, 1):
+        buf += position_cursor(row) + clear_line()
+        s = s[:terminalColumns]
+        if searchText and row == rows:
+            s = reverse_video(s)
+        buf += s
+    buf += restore_cursor_position()
+
+    # Everything pending is in the window now
+    pendingLines.clear()
+    if scrollOffset:
+        buf += status_line(f"-- {scrollOffset} newer messages below, /pgdn to return --")
+    else:
+        buf += status_line("")
+    print_now(buf)
+
+def status_line(s):
+    # The line between the messages and the prompt
+    buf = save_cursor_position()
+    buf += position_cursor(get_terminal_lines() - 2)
+    buf += clear_line()
+    buf += s[:terminalColumns]
+    buf += restore_cursor_position()
+    return buf
 
 def print_now(s):
     print(s, end="", flush=True)
 
 def get_terminal_lines():
-    _, lines = os.get_terminal_size()
-    return lines
+    if terminalLines is None:
+        refresh_terminal_size()
+    return terminalLines
+
+def refresh_terminal_size():
+    global terminalLines, terminalColumns
+
+    terminalColumns, terminalLines = os.get_terminal_size()
 
 def clear_line():
     return "\x1b[2K"
@@ -46,6 +215,9 @@ def clear_line():
 def clear_screen():
     return "\x1b[2J"
 
+def reverse_video(s):
+    return f"\x1b[7m{s}\x1b[m"
+
 def save_cursor_position():
     #return "\x1b7\x1b[s"
     #return "\x1b[s"
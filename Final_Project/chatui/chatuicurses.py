@@ -1,6 +1,19 @@
+from itertools import islice
+from collections import deque
+
 from unicurses import *
 
+# Messages kept for scrolling back, the oldest are dropped past this
+SCROLLBACK_LINES = 5000
+
 upper_window = None
+# The last SCROLLBACK_LINES messages, oldest first
+scrollback = deque(maxlen=SCROLLBACK_LINES)
+# How many messages up from the newest the bottom of the window is, 0
+# while following new messages
+scroll_offset = 0
+# What the last search was for, its match is the bottom line
+search_text = ""
 
 def init_windows():
     global stdscr
@@ -46,6 +59,13 @@ def read_command(prompt="> "):
 def print_message(s):
     global upper_window
     global stdscr
+    global scroll_offset
+
+    scrollback.append(s)
+    # Scrolled back, keep the window where it is
+    if scroll_offset:
+        scroll_offset = min(scroll_offset + 1, len(scrollback) - 1)
+        return
 
     pos = getyx(stdscr)
 
@@ -56,6 +76,90 @@ def print_message(s):
 
     refresh()
 
+def scroll_up():
+    global scroll_offset
+    global search_text
+
+    search_text = ""
+    scroll_offset = min(scroll_offset + page_size(), max(len(scrollback) - 1, 0))
+    draw_scrollback()
+
+def scroll_down():
+    global scroll_offset
+    global search_text
+
+    search_text = ""
+    scroll_offset = max(scroll_offset - page_size(), 0)
+    draw_scrollback()
+
+def search_scrollback(text=""):
+    # Scroll to the newest message above the last match that has text in
+    # it, any case. Text that extends the last search can still match the
+    # message matched last, an empty text looks for the last one again.
+    global scroll_offset
+    global search_text
+
+    if not text:
+        text = search_text
+        start = scroll_offset + 1
+    elif search_text and text.lower().startswith(search_text.lower()):
+        start = scroll_offset
+    else:
+        start = 0
+    if not text:
+        return False
+
+    wanted = text.lower()
+    for offset, line in enumerate(islice(reversed(scrollback), start, None), start):
+        if wanted in line.lower():
+            scroll_offset = offset
+            search_text = text
+            draw_scrollback()
+            return True
+
+    draw_status(f"-- no match for {text} --")
+    return False
+
+def page_size():
+    rows, _ = getmaxyx(upper_window)
+    return max(rows - 1, 1)
+
+def draw_scrollback():
+    pos = getyx(stdscr)
+    rows, cols = getmaxyx(upper_window)
+    end = len(scrollback) - scroll_offset
+    visible = list(islice(scrollback, max(end - rows, 0), end))
+
+    werase(upper_window)
+    # Bottom aligned like new messages
+    top = rows - len(visible)
+    for row, s in enumerate(visible, top):
+        attributes = A_REVERSE if search_text and row == rows - 1 else A_NORMAL
+        wattron(upper_window, attributes)
+        mvwaddnstr(upper_window, row, 0, s, cols - 1)
+        wattroff(upper_window, attributes)
+    wrefresh(upper_window)
+
+    if scroll_offset:
+        draw_status(f"-- {scroll_offset} newer messages below, /pgdn to return --")
+    else:
+        draw_status("")
+
+    move(*pos)
+    refresh()
+
+def draw_status(s):
+    # The line between the messages and the prompt
+    pos = getyx(stdscr)
+    lines, cols = getmaxyx(stdscr)
+
+    move(lines - 3, 0)
+    clrtoeol()
+    mvaddnstr(lines - 3, 0, s, cols - 1)
+
+    move(*pos)
+    refresh()
+
 def end_windows():
     clear()
     refresh()
@@ -1,37 +1,35 @@
+import os
 import sys
 import socket
 
-# How many bytes is the word length?
-WORD_LEN_SIZE = 2
+# The frame decoder is shared with the chat client and server
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "..", "Final_Project"))
+from chat_protocol import FrameDecoder
 
 def usage():
     print("usage: wordclient.py server port", file=sys.stderr)
 
-packet_buffer = b''
+# Every word has a 2 byte length in front of it
+packet_decoder = FrameDecoder("u16")
 
 def get_next_word_packet(s):
     """
     Return the next word packet from the stream.
 
     The word packet consists of the encoded word length followed by the
-    UTF-8-encoded word.
+    UTF-8-encoded word. The length is taken off by the decoder, so only
+    the encoded word is returned.
 
     Returns None if there are no more words, i.e. the server has hung
     up.
     """
-    global packet_buffer
-
     while True:
 
         # Start checking to see if the full packet is in the buffer
-        if len(packet_buffer) >= WORD_LEN_SIZE:
-            packetLength = int.from_bytes(packet_buffer[:2], "big")
-
-            # Full Packet in buffer, Extract and Return
-            if len(packet_buffer) >= (packetLength + 2):
-                fullPacket = packet_buffer[:packetLength + 2]
-                packet_buffer = packet_buffer[packetLength + 2:]
-                return fullPacket
+        wordBytes = packet_decoder.next_frame()
+        if wordBytes is not None:
+            return wordBytes
 
         # Get new Data from Socket
         newData = s.recv(4096)
@@ -41,21 +39,20 @@ def get_next_word_packet(s):
             return None
         
         # There was new data, Add it to the buffer
-        packet_buffer += newData
+        packet_decoder.feed(newData)
 
 
 def extract_word(word_packet):
     """
     Extract a word from a word packet.
 
-    word_packet: a word packet consisting of the encoded word length
-    followed by the UTF-8 word.
+    word_packet: the encoded word from get_next_word_packet(), without
+    its length.
 
     Returns the word decoded as a string.
     """
 
-    wordBytes = word_packet[2:]
-    wordDecoded = wordBytes.decode("ISO-8859-1")
+    wordDecoded = word_packet.decode("ISO-8859-1")
     return wordDecoded
 
 # Do not modify: